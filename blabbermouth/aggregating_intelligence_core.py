@@ -1,15 +1,98 @@
+import asyncio
+import functools
 import random
+import time
 
 import attr
 
 from intelligence_core import IntelligenceCore
+from util.circuit_breaker import BreakerState, CircuitBreaker
+from util import metrics, tracing
 from util.log import logged
 
+_CORE_SECONDS = metrics.histogram("blabbermouth_core_seconds", "Intelligence core latency", ["core"])
+_CORE_CALLS = metrics.counter(
+    "blabbermouth_core_calls_total", "Intelligence core calls by outcome", ["core", "outcome"]
+)
+_CIRCUIT_OPEN = metrics.gauge(
+    "blabbermouth_core_circuit_open", "Whether the circuit of a core is not closed", ["core"]
+)
+
+
+def _non_negative(instance, attribute, value):
+    if value < 0:
+        raise ValueError("{} must not be negative, got {}".format(attribute.name, value))
+
+
+@logged
+@attr.s(slots=True)
+class CoreHealth:
+    _MIN_SUCCESS_RATE = 0.05
+
+    _name = attr.ib()
+    _weight = attr.ib(validator=_non_negative)
+    _smoothing = attr.ib()
+    timeout = attr.ib()
+    breaker = attr.ib(validator=attr.validators.instance_of(CircuitBreaker))
+
+    latency = attr.ib(default=None)
+    success_rate = attr.ib(default=1.0)
+    successes = attr.ib(default=0)
+    failures = attr.ib(default=0)
+    timeouts = attr.ib(default=0)
+    rejections = attr.ib(default=0)
+
+    def __attrs_post_init__(self):
+        _CIRCUIT_OPEN.labels(self._name).set_function(lambda: self.breaker.state is not BreakerState.CLOSED)
+        for outcome in ("successes", "failures", "timeouts", "rejections"):
+            _CORE_CALLS.labels(self._name, outcome).set_function(functools.partial(getattr, self, outcome))
+
+    @property
+    def is_enabled(self):
+        return self._weight > 0
+
+    @property
+    def effective_weight(self):
+        return self._weight * max(self.success_rate, self._MIN_SUCCESS_RATE)
+
+    def allow(self):
+        if self.breaker.allow():
+            return True
+        self.rejections += 1
+        return False
+
+    def record_success(self, latency):
+        self.successes += 1
+        _CORE_SECONDS.labels(self._name).observe(latency)
+        self.latency = latency if self.latency is None else self._smooth(self.latency, latency)
+        self.success_rate = self._smooth(self.success_rate, 1.0)
+        self.breaker.record_success()
+
+    def record_failure(self, reason, is_timeout=False):
+        self.failures += 1
+        self.timeouts += is_timeout
+        self.success_rate = self._smooth(self.success_rate, 0.0)
+        was_closed = self.breaker.state is BreakerState.CLOSED
+        self.breaker.record_failure()
+        if self.breaker.state is BreakerState.OPEN and was_closed:
+            self._log.warning("Opened circuit of {} core after {}".format(self._name, reason))
+        else:
+            self._log.info("Core {} failed: {}".format(self._name, reason))
+
+    def record_abandon(self):
+        self.breaker.record_abandon()
+
+    def _smooth(self, average, value):
+        return average + self._smoothing * (value - average)
+
 
 @logged
 @attr.s(slots=True)
 class AggregatingIntelligenceCore(IntelligenceCore):
     _cores = attr.ib()
+    _health = attr.ib()
+    _deadline = attr.ib()
+    _hedge_delay = attr.ib()
 
     async def conceive(self):
         return await self._try_cores(lambda core: core.conceive())
@@ -18,14 +101,62 @@ class AggregatingIntelligenceCore(IntelligenceCore):
         return await self._try_cores(lambda core: core.respond(user, message))
 
     async def _try_cores(self, coro):
-        cores = self._cores.copy()
-        random.shuffle(cores)
-        for core in cores:
-            try:
-                result = await coro(core)
-            except Exception as ex:
-                self._log.exception(ex)
-            else:
-                if result is not None:
-                    return result
-        return None
+        # Another core starts whenever one fails or stays silent for the hedge delay, the first answer wins
+        deadline = time.monotonic() + self._deadline
+        candidates = self._weighted_order()
+        running = {}
+        try:
+            while True:
+                if not self._start_next(candidates, running, coro) and not running:
+                    return None
+
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    self._log.warning("No core answered in {}s".format(self._deadline))
+                    return None
+
+                done, _ = await asyncio.wait(
+                    set(running), timeout=min(timeout, self._hedge_delay), return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    del running[task]
+                    if task.result() is not None:
+                        return task.result()
+        finally:
+            for task in running:
+                task.cancel()
+
+    def _weighted_order(self):
+        # Weighted sampling without replacement, failing cores are tried last and zero weight ones never
+        return sorted(
+            (name for name in self._cores if self._health[name].is_enabled),
+            key=lambda name: random.random() ** (1.0 / self._health[name].effective_weight),
+            reverse=True,
+        )
+
+    def _start_next(self, candidates, running, coro):
+        while candidates:
+            name = candidates.pop(0)
+            if self._health[name].allow():
+                running[asyncio.ensure_future(self._call_core(name, coro))] = name
+                return True
+        return False
+
+    async def _call_core(self, name, coro):
+        health = self._health[name]
+        started = time.monotonic()
+        try:
+            with tracing.span("core:{}".format(name)):
+                result = await asyncio.wait_for(coro(self._cores[name]), health.timeout)
+        except asyncio.CancelledError:
+            health.record_abandon()
+            raise
+        except asyncio.TimeoutError:
+            health.record_failure("timing out in {}s".format(health.timeout), is_timeout=True)
+            return None
+        except Exception as ex:
+            health.record_failure(repr(ex))
+            return None
+
+        health.record_success(time.monotonic() - started)
+        return result
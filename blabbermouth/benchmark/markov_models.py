@@ -0,0 +1,94 @@
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+
+from compact_markov_model import CompactMarkovModel
+from markov_model import MarkovifyModel
+
+MODELS = {"markovify": MarkovifyModel, "compact": CompactMarkovModel}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", help="File with one sentence per line, synthetic corpus if omitted")
+    parser.add_argument("--sentences", type=int, default=100000)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--samples", type=int, default=1000)
+    parser.add_argument("--tries", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def synthetic_corpus(sentences, vocabulary, seed):
+    rng = random.Random(seed)
+    words = ["w{}".format(i) for i in range(vocabulary)]
+    weights = [1.0 / (rank + 1) for rank in range(vocabulary)]
+    # Capitalized sentences so markovify splits the joined corpus back into the same sentences
+    return [
+        " ".join(rng.choices(words, weights=weights, k=rng.randint(3, 20))).capitalize()
+        for _ in range(sentences)
+    ]
+
+
+def load_corpus(args):
+    if args.corpus is None:
+        return synthetic_corpus(args.sentences, args.vocabulary, args.seed)
+    with open(args.corpus) as corpus_fd:
+        return [line.strip() for line in corpus_fd if line.strip()]
+
+
+def batched(corpus, batch_size):
+    for start in range(0, len(corpus), batch_size):
+        yield corpus[start : start + batch_size]
+
+
+def measure(model_class, corpus, batch_size, samples, tries):
+    gc.collect()
+    started = time.perf_counter()
+    model = model_class.build(batched(corpus, batch_size))
+    build_seconds = time.perf_counter() - started
+
+    # Tracing allocations slows a build down several times, so memory is measured on a build of its own
+    del model
+    gc.collect()
+    tracemalloc.start()
+    model = model_class.build(batched(corpus, batch_size))
+    retained_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    produced = 0
+    started = time.perf_counter()
+    for _ in range(samples):
+        if model.make_sentence(tries=tries) is not None:
+            produced += 1
+    sample_seconds = time.perf_counter() - started
+
+    return {
+        "build_seconds": build_seconds,
+        "retained_megabytes": retained_bytes / 1024 / 1024,
+        "peak_megabytes": peak_bytes / 1024 / 1024,
+        "sentences_per_second": samples / sample_seconds,
+        "produced": produced,
+    }
+
+
+def main():
+    args = parse_args()
+    corpus = load_corpus(args)
+    print("Corpus: {} sentences".format(len(corpus)))
+
+    for name, model_class in MODELS.items():
+        random.seed(args.seed)
+        result = measure(model_class, corpus, args.batch_size, args.samples, args.tries)
+        print(
+            "{:>10}: build {build_seconds:.2f}s, retained {retained_megabytes:.1f}MB, "
+            "peak {peak_megabytes:.1f}MB, {sentences_per_second:.0f} sentences/s "
+            "({produced} produced)".format(name, **result)
+        )
+
+
+if __name__ == "__main__":
+    main()
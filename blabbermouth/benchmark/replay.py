@@ -0,0 +1,268 @@
+import argparse
+import asyncio
+import collections
+import datetime
+import functools
+import json
+import random
+import resource
+import statistics
+import tempfile
+import time
+
+import attr
+import telepot
+
+import bot_factory
+import chat_intelligence
+import intelligence_core_factory
+from benchmark.markov_models import synthetic_corpus
+from learning_feed import LearningFeed
+from outbound_dispatcher import BotTransport, OutboundDispatcher
+from markov_chain_intelligence_core import MarkovChainIntelligenceCore
+from memory_knowledge_base import MemoryKnowledgeBase
+from util import config
+from work_scheduler import Priority, WorkScheduler
+
+_REPLY_METHODS = ("sendMessage", "sendVoice")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--messages-file", help="File with one Telegram message per line, synthetic if omitted"
+    )
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--history", type=int, default=50000)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--mention-ratio", type=float, default=0.05)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--worker-mode", choices=("thread", "process"), default="thread")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+class ReplayBot(telepot.aio.DelegatorBot):
+    def __init__(self, *args, on_reply, **kwargs):
+        super(ReplayBot, self).__init__(*args, **kwargs)
+        self._on_reply = on_reply
+        self._message_ids = iter(range(1, 2**63))
+
+    async def _api_request(self, method, params=None, files=None, **kwargs):
+        if method in _REPLY_METHODS:
+            self._on_reply(params["chat_id"])
+        return {"message_id": next(self._message_ids)}
+
+
+@attr.s(slots=True)
+class TimedMarkovWorker:
+    _worker = attr.ib()
+    build_seconds = attr.ib(factory=list)
+
+    async def build(self, model_class, batches):
+        started = time.perf_counter()
+        try:
+            return await self._worker.build(model_class, batches)
+        finally:
+            self.build_seconds.append(time.perf_counter() - started)
+
+    def __getattr__(self, name):
+        return getattr(self._worker, name)
+
+
+@attr.s(slots=True)
+class ReplyTracker:
+    _pending = attr.ib(factory=lambda: collections.defaultdict(collections.deque))
+    latencies = attr.ib(factory=list)
+    unexpected = attr.ib(default=0)
+
+    def expect(self, chat_id):
+        self._pending[chat_id].append(time.perf_counter())
+
+    def on_reply(self, chat_id):
+        pending = self._pending.get(chat_id)
+        if not pending:
+            self.unexpected += 1
+            return
+        self.latencies.append(time.perf_counter() - pending.popleft())
+
+    @property
+    def outstanding(self):
+        return sum(len(pending) for pending in self._pending.values())
+
+
+def synthetic_messages(args, bot_name):
+    rng = random.Random(args.seed)
+    sentences = synthetic_corpus(args.messages, args.vocabulary, args.seed)
+    for message_id, sentence in enumerate(sentences, start=1):
+        user = "user{}".format(rng.randrange(args.users))
+        if rng.random() < args.mention_ratio:
+            sentence = "@{} {}".format(bot_name, sentence)
+        yield {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": -rng.randrange(1, args.chats + 1), "type": "group"},
+            "from": {"id": hash(user), "username": user},
+            "text": sentence,
+        }
+
+
+def load_messages(args, bot_name):
+    if args.messages_file is None:
+        return list(synthetic_messages(args, bot_name))
+    with open(args.messages_file) as messages_fd:
+        return [json.loads(line) for line in messages_fd if line.strip()]
+
+
+async def seed_history(knowledge_base, args):
+    rng = random.Random(args.seed + 1)
+    for sentence in synthetic_corpus(args.history, args.vocabulary, args.seed + 1):
+        await knowledge_base.record(
+            chat_id=-rng.randrange(1, args.chats + 1),
+            user="user{}".format(rng.randrange(args.users)),
+            text=sentence,
+        )
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+async def replay(event_loop, args):
+    conf = config.load_config(
+        "config", "env.yaml", {"is_prod": False, "token": "replay", "yandex_dev_api_key": "replay"}
+    )
+    conf["markov_chain_intelligence_core"]["snapshot_directory"] = tempfile.mkdtemp(prefix="replay-")
+    conf["markov_chain_intelligence_core"]["worker_mode"] = args.worker_mode
+
+    knowledge_base = MemoryKnowledgeBase()
+    await seed_history(knowledge_base, args)
+
+    learning_feed = LearningFeed()
+    markov_chain_worker = TimedMarkovWorker(
+        worker=intelligence_core_factory.build_markov_worker(event_loop=event_loop, conf=conf)
+    )
+    markov_text_registry = intelligence_core_factory.build_markov_text_registry(
+        event_loop=event_loop,
+        knowledge_base=knowledge_base,
+        learning_feed=learning_feed,
+        markov_chain_worker=markov_chain_worker,
+        conf=conf,
+    )
+    # Only the Markov core takes part, the other cores would call external services
+    intelligence_registry = chat_intelligence.IntelligenceRegistry.build(
+        core_constructor=functools.partial(MarkovChainIntelligenceCore, text_registry=markov_text_registry),
+        cache_size=conf["chat_intelligence"]["core_cache_size"],
+        cache_idle_ttl=datetime.timedelta(hours=conf["chat_intelligence"]["core_cache_idle_ttl_hours"]),
+    )
+
+    work_scheduler = WorkScheduler(
+        event_loop=event_loop,
+        concurrency=conf["work_scheduler"]["concurrency"],
+        reply_reserve=conf["work_scheduler"]["reply_reserve"],
+        chat_concurrency=conf["work_scheduler"]["chat_concurrency"],
+        queue_depth=conf["work_scheduler"]["queue_depth"],
+        chat_queue_depth=conf["work_scheduler"]["chat_queue_depth"],
+    )
+
+    outbound_dispatcher = OutboundDispatcher.build(
+        event_loop=event_loop,
+        transport=BotTransport(bot_accessor=lambda: bot),
+        global_rate=conf["outbound_dispatcher"]["global_rate"],
+        chat_rate=conf["outbound_dispatcher"]["chat_rate"],
+        chat_burst=conf["outbound_dispatcher"]["chat_burst"],
+        chatter_stale_after=datetime.timedelta(
+            seconds=conf["outbound_dispatcher"]["chatter_stale_after_seconds"]
+        ),
+        max_retries=conf["outbound_dispatcher"]["max_retries"],
+        max_in_flight=conf["outbound_dispatcher"]["max_in_flight"],
+    )
+
+    tracker = ReplyTracker()
+    bot = bot_factory.build(
+        bot_token=conf["token"],
+        bot_name=conf["bot_name"],
+        bot_accessor=lambda: bot,
+        intelligence_registry=intelligence_registry,
+        knowledge_base=knowledge_base,
+        learning_feed=learning_feed,
+        work_scheduler=work_scheduler,
+        outbound_dispatcher=outbound_dispatcher,
+        telepot_http_timeout=conf["telepot"]["http_timeout"],
+        conf=conf,
+        bot_class=functools.partial(ReplayBot, on_reply=tracker.on_reply),
+    )
+
+    messages = load_messages(args, conf["bot_name"])
+    self_reference = "@{}".format(conf["bot_name"])
+    history_size = await knowledge_base.last_record_id() or 0
+    expected_records = history_size + sum(
+        1 for message in messages if "text" in message and self_reference not in message["text"]
+    )
+
+    started = time.perf_counter()
+    for message in messages:
+        if self_reference in message.get("text", ""):
+            tracker.expect(message["chat"]["id"])
+        bot.handle(message)
+        await asyncio.sleep(0)
+
+    deadline = started + args.timeout
+    ingested_at = None
+    while time.perf_counter() < deadline:
+        shed_records = work_scheduler.dropped[Priority.LEARNING.name]
+        if (
+            ingested_at is None
+            and (await knowledge_base.last_record_id() or 0) + shed_records >= expected_records
+        ):
+            ingested_at = time.perf_counter()
+        if ingested_at is not None and not tracker.outstanding:
+            break
+        await asyncio.sleep(0.01)
+    finished = time.perf_counter()
+
+    ingested = (await knowledge_base.last_record_id() or 0) - history_size
+    print("Replayed {} messages over {} history records".format(len(messages), history_size))
+    print(
+        "Ingested: {} records, {:.0f} messages/s".format(
+            ingested, ingested / ((ingested_at or finished) - started)
+        )
+    )
+    print("Dropped work: {}".format(dict(work_scheduler.dropped)))
+    print(
+        "Replies: {} answered, {} unanswered, {} unexpected".format(
+            len(tracker.latencies), tracker.outstanding, tracker.unexpected
+        )
+    )
+    print(
+        "Reply latency: p50 {:.3f}s, p90 {:.3f}s, p99 {:.3f}s, max {:.3f}s".format(
+            percentile(tracker.latencies, 0.5),
+            percentile(tracker.latencies, 0.9),
+            percentile(tracker.latencies, 0.99),
+            max(tracker.latencies, default=float("nan")),
+        )
+    )
+    build_seconds = markov_chain_worker.build_seconds
+    print(
+        "Model builds: {}, mean {:.3f}s, max {:.3f}s".format(
+            len(build_seconds),
+            statistics.mean(build_seconds) if build_seconds else float("nan"),
+            max(build_seconds, default=float("nan")),
+        )
+    )
+    print("Peak RSS: {:.1f}MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def main():
+    args = parse_args()
+    event_loop = asyncio.get_event_loop()
+    event_loop.run_until_complete(replay(event_loop, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import asyncio
+import time
+
+import aiohttp
+
+from benchmark.replay import percentile, synthetic_messages
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8443/telegram/webhook")
+    parser.add_argument("--bot-name", default="anna_karina_bot")
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--mention-ratio", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+async def post_updates(session, url, updates, latencies, failures):
+    for update in updates:
+        started = time.perf_counter()
+        async with session.post(url, json=update) as response:
+            await response.read()
+            if response.status != 200:
+                failures.append(response.status)
+        latencies.append(time.perf_counter() - started)
+
+
+async def run(args):
+    updates = [
+        {"update_id": update_id, "message": message}
+        for update_id, message in enumerate(synthetic_messages(args, args.bot_name), start=1)
+    ]
+    latencies = []
+    failures = []
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        # Like Telegram, every connection delivers its share of updates one after another
+        await asyncio.gather(
+            *(
+                post_updates(session, args.url, updates[index :: args.concurrency], latencies, failures)
+                for index in range(args.concurrency)
+            )
+        )
+    elapsed = time.perf_counter() - started
+
+    print(
+        "Posted {} updates, {:.0f} updates/s, {} failed".format(
+            len(updates), len(updates) / elapsed, len(failures)
+        )
+    )
+    print(
+        "Request latency: p50 {:.4f}s, p90 {:.4f}s, p99 {:.4f}s".format(
+            percentile(latencies, 0.5), percentile(latencies, 0.9), percentile(latencies, 0.99)
+        )
+    )
+
+
+def main():
+    asyncio.get_event_loop().run_until_complete(run(parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,10 @@ import datetime
 import telepot
 from telepot.aio.delegate import per_chat_id, create_open, pave_event_space
 
-import chat_intelligence
-import chatter_handler
-import deaf_detector
-import learning_handler
+from chat_pipeline import ChatPipeline
+from chatter_handler import ChatterStage
+from deaf_detector import DeafDetectorStage
+from learning_handler import LearningStage
 from util import query_detector
 
 
@@ -14,45 +14,47 @@ def build(
     bot_token,
     bot_name,
     bot_accessor,
-    event_loop,
     intelligence_registry,
     knowledge_base,
+    learning_feed,
+    work_scheduler,
+    outbound_dispatcher,
     telepot_http_timeout,
     conf,
+    bot_class=telepot.aio.DelegatorBot,
 ):
-    telepot.aio.DelegatorBot(
+    # Stages are shared by all chats, per chat data lives in the pipeline's chat state
+    stages = [
+        DeafDetectorStage(work_scheduler=work_scheduler),
+        LearningStage(
+            knowledge_base=knowledge_base,
+            learning_feed=learning_feed,
+            bot_name=bot_name,
+            work_scheduler=work_scheduler,
+        ),
+        ChatterStage(
+            work_scheduler=work_scheduler,
+            intelligence_registry=intelligence_registry,
+            bot_accessor=bot_accessor,
+            personal_query_detector=query_detector.personal_query_detector(bot_name),
+            conceive_interval=datetime.timedelta(hours=conf["chatter_handler"]["conceive_interval_hours"]),
+            conceive_lookahead=datetime.timedelta(
+                minutes=conf["chatter_handler"]["conceive_lookahead_minutes"]
+            ),
+            answer_placeholder=conf["chatter_handler"]["answer_placeholder"],
+        ),
+    ]
+    return bot_class(
         bot_token,
         [
             _make_per_chat_handler(
-                deaf_detector.DeafDetectorHandler, event_loop=event_loop, timeout=telepot_http_timeout
-            ),
-            _make_per_chat_handler(
-                chat_intelligence.ChatIntelligence,
-                intelligence_registry=intelligence_registry,
-                timeout=telepot_http_timeout,
-            ),
-            _make_per_chat_handler(
-                learning_handler.LearningHandler,
-                knowledge_base=knowledge_base,
+                ChatPipeline,
+                stages=stages,
+                outbound_dispatcher=outbound_dispatcher,
                 self_reference_detector=query_detector.self_reference_detector(bot_name),
-                bot_name=bot_name,
-                event_loop=event_loop,
-                timeout=telepot_http_timeout,
-            ),
-            _make_per_chat_handler(
-                chatter_handler.ChatterHandler,
-                event_loop=event_loop,
-                intelligence_registry=intelligence_registry,
-                bot_accessor=bot_accessor,
-                self_reference_detector=query_detector.self_reference_detector(bot_name),
-                personal_query_detector=query_detector.personal_query_detector(bot_name),
-                conceive_interval=datetime.timedelta(
-                    hours=conf["chatter_handler"]["conceive_interval_hours"]
-                ),
                 callback_lifespan=datetime.timedelta(days=conf["chatter_handler"]["callback_lifespan_days"]),
-                answer_placeholder=conf["chatter_handler"]["answer_placeholder"],
                 timeout=telepot_http_timeout,
-            ),
+            )
         ],
     )
 
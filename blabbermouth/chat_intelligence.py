@@ -1,32 +1,24 @@
 import attr
-import telepot
 
-from util.log import logged
+from util.bounded_cache import BoundedCache
 
 
 @attr.s(slots=True)
 class IntelligenceRegistry:
     _core_constructor = attr.ib()
-    _cores = attr.ib(factory=dict)
+    _cores = attr.ib(validator=attr.validators.instance_of(BoundedCache))
 
-    def create_core(self, chat_id):
-        self._cores[chat_id] = self._core_constructor(chat_id)
+    @classmethod
+    def build(cls, core_constructor, cache_size, cache_idle_ttl):
+        return cls(
+            core_constructor=core_constructor,
+            cores=BoundedCache(name="intelligence cores", max_size=cache_size, idle_ttl=cache_idle_ttl),
+        )
 
     def get_core(self, chat_id):
-        return self._cores[chat_id]
-
-
-@logged
-class ChatIntelligence(telepot.aio.helper.ChatHandler):
-    def __init__(self, *args, intelligence_registry, **kwargs):
-        super(ChatIntelligence, self).__init__(*args, **kwargs)
-
-        intelligence_registry.create_core(self.chat_id)
-
-        self._log.info("Created {}".format(id(self)))
-
-    async def on_chat_message(self, message):
-        pass
-
-    def on__idle(self, _):
-        self._log.debug("Ignoring on__idle")
+        # Cores of idle chats are evicted and created again on demand
+        core = self._cores.get(chat_id)
+        if core is None:
+            core = self._core_constructor(chat_id)
+            self._cores.put(chat_id, core)
+        return core
@@ -0,0 +1,66 @@
+import attr
+import telepot
+
+from callback_query import CallbackQuery
+from deaf_detector import DeafDetector
+from util import tracing
+from util.log import logged
+
+
+@attr.s(slots=True, frozen=True)
+class Glance:
+    message = attr.ib()
+    text = attr.ib()
+    user = attr.ib()
+    is_self_reference = attr.ib()
+
+
+@attr.s(slots=True)
+class ChatState:
+    chat_id = attr.ib()
+    sender = attr.ib()
+    callback_query = attr.ib(validator=attr.validators.instance_of(CallbackQuery))
+    deaf_detector = attr.ib(factory=DeafDetector)
+    conceive_timer = attr.ib(default=None)
+    next_thought = attr.ib(default=None)
+
+
+@logged
+class ChatPipeline(telepot.aio.helper.ChatHandler):
+    def __init__(
+        self, *args, stages, outbound_dispatcher, self_reference_detector, callback_lifespan, **kwargs
+    ):
+        super(ChatPipeline, self).__init__(*args, include_callback_query=True, **kwargs)
+
+        self._stages = stages
+        self._self_reference_detector = self_reference_detector
+        self._state = ChatState(
+            chat_id=self.chat_id,
+            sender=outbound_dispatcher.sender(self.chat_id),
+            callback_query=CallbackQuery(callback_lifespan=callback_lifespan),
+        )
+        self.on_callback_query = self._state.callback_query.on_callback_query
+
+        for stage in self._stages:
+            stage.open(self._state)
+
+        self._log.info("Created {}".format(id(self)))
+
+    async def on_chat_message(self, message):
+        # The message is inspected once, stages share the result and the chat state
+        glance = Glance(
+            message=message,
+            text=message.get("text"),
+            user=message.get("from", {}).get("username"),
+            is_self_reference=bool(self._self_reference_detector(message)),
+        )
+        with tracing.trace("chat_message"):
+            for stage in self._stages:
+                try:
+                    with tracing.span(type(stage).__name__):
+                        await stage.on_message(glance, self._state)
+                except Exception as ex:
+                    self._log.exception(ex)
+
+    def on__idle(self, _):
+        self._log.debug("Ignoring on__idle")
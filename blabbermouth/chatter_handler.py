@@ -1,96 +1,127 @@
+import asyncio
 import datetime
 import functools
 import random
+import time
 
-import telepot
+import attr
 
-from callback_query import CallbackQuery
 from markup import InlineButton
+from outbound_dispatcher import Urgency
 from thought import text as thought_text
 from thought import Type as ThoughtType
-from util.chain import chained, check, not_none
+from util import metrics, tracing
 from util.log import logged
 from util.timer import Timer
+from work_scheduler import Priority, WorkScheduler
 
+_THOUGHTS_SENT = metrics.counter(
+    "blabbermouth_thoughts_sent_total", "Thoughts sent to chats", ["urgency", "thought_type"]
+)
+_REPLY_SECONDS = metrics.histogram("blabbermouth_reply_seconds", "Time from a mention to the sent reply")
+_CONCEIVE_SECONDS = metrics.histogram("blabbermouth_conceive_seconds", "Time to conceive and send a thought")
 
-@logged
-class ChatterHandler(telepot.aio.helper.ChatHandler):
-    def __init__(
-        self,
-        *args,
-        event_loop,
-        intelligence_registry,
-        bot_accessor,
-        self_reference_detector,
-        personal_query_detector,
-        conceive_interval,
-        callback_lifespan,
-        answer_placeholder,
-        **kwargs
-    ):
-        super(ChatterHandler, self).__init__(*args, include_callback_query=True, **kwargs)
-
-        self._event_loop = event_loop
-        self._intelligence_registry = intelligence_registry
-        self._bot_accessor = bot_accessor
-        self._self_reference_detector = self_reference_detector
-        self._personal_quary_detector = personal_query_detector
-        self._conceive_interval = conceive_interval
-        self._conceive_timer = Timer(callback=self._conceive, interval=self._randomize_conceive_interval())
-        self._answer_placeholder = thought_text(answer_placeholder)
-
-        self._callback_query = CallbackQuery(callback_lifespan=callback_lifespan)
-        self.on_callback_query = self._callback_query.on_callback_query
-
-        self._log.info("Created {}".format(id(self)))
-
-    async def on_chat_message(self, message):
-        self._event_loop.create_task(self._on_chat_message(message))
-
-    @chained
-    async def _on_chat_message(self, message):
-        check(self._self_reference_detector(message))
-        source = not_none(message.get("from"))
-        user = not_none(source.get("username"))
-
-        self._log.info("User {} in chat {} is talking to me".format(user, self.chat_id))
-
-        intelligence_core = self._intelligence_registry.get_core(self.chat_id)
-
-        answer = await intelligence_core.respond(user=user, message=message.get("text", ""))
-        if answer is None:
-            self._log.info('Got "None" answer from intelligence core')
-            answer = self._answer_placeholder
-
-        await self._send_thought(answer)
 
-    def on__idle(self, _):
-        self._log.debug("Ignoring on__idle")
+@logged
+@attr.s(slots=True)
+class ChatterStage:
+    _work_scheduler = attr.ib(validator=attr.validators.instance_of(WorkScheduler))
+    _intelligence_registry = attr.ib()
+    _bot_accessor = attr.ib()
+    _personal_query_detector = attr.ib()
+    _conceive_interval = attr.ib(validator=attr.validators.instance_of(datetime.timedelta))
+    _conceive_lookahead = attr.ib(validator=attr.validators.instance_of(datetime.timedelta))
+    _answer_placeholder = attr.ib(converter=thought_text)
+
+    def open(self, state):
+        state.conceive_timer = Timer(
+            callback=functools.partial(self._conceive, state), interval=self._randomize_conceive_interval()
+        )
+        self._schedule_prerender(state)
+
+    async def on_message(self, glance, state):
+        if not glance.is_self_reference or glance.user is None:
+            return
+        self._work_scheduler.submit(
+            state.chat_id, Priority.REPLY, functools.partial(self._reply, glance, state, time.perf_counter())
+        )
 
-    async def _conceive(self):
-        intelligence_core = self._intelligence_registry.get_core(self.chat_id)
+    async def _reply(self, glance, state, received_at):
+        self._log.info("User {} in chat {} is talking to me".format(glance.user, state.chat_id))
 
-        thought = await intelligence_core.conceive()
-        if thought is None:
-            self._log.info("No new thoughts from intellegence core")
-            return
+        intelligence_core = self._intelligence_registry.get_core(state.chat_id)
 
-        await self._send_thought(thought)
+        with tracing.span("respond"):
+            answer = await intelligence_core.respond(user=glance.user, message=glance.text or "")
+        if answer is None:
+            self._log.info('Got "None" answer from intelligence core')
+            answer = self._answer_placeholder
 
-        self._conceive_timer.interval = self._randomize_conceive_interval()
+        with tracing.span("send"):
+            await self._send_thought(answer, state)
+        _REPLY_SECONDS.observe(time.perf_counter() - received_at)
+
+    async def _conceive(self, state):
+        started_at = time.perf_counter()
+        try:
+            with tracing.trace("conceive"):
+                thought = await self._next_thought(state)
+                if thought is None:
+                    self._log.info("No new thoughts from intellegence core")
+                    return
+
+                with tracing.span("send"):
+                    await self._send_thought(thought, state, urgency=Urgency.CHATTER)
+            _CONCEIVE_SECONDS.observe(time.perf_counter() - started_at)
+
+            state.conceive_timer.interval = self._randomize_conceive_interval()
+        finally:
+            self._schedule_prerender(state)
+
+    async def _next_thought(self, state):
+        prerendered, state.next_thought = state.next_thought, None
+        if prerendered is not None and prerendered.done() and prerendered.result() is not None:
+            return prerendered.result()
+        # A prerender that was shed, failed or is late is not waited for
+        if prerendered is not None:
+            prerendered.cancel()
+        return await self._intelligence_registry.get_core(state.chat_id).conceive()
+
+    def _schedule_prerender(self, state):
+        # The next thought, speech included, is made shortly before the timer fires, off the critical path
+        delay = state.conceive_timer.interval - self._conceive_lookahead
+        asyncio.get_event_loop().call_later(max(0.0, delay.total_seconds()), self._submit_prerender, state)
+
+    def _submit_prerender(self, state):
+        state.next_thought = asyncio.get_event_loop().create_future()
+        self._work_scheduler.submit(
+            state.chat_id, Priority.PRERENDER, functools.partial(self._prerender, state.next_thought, state)
+        )
+
+    async def _prerender(self, next_thought, state):
+        try:
+            with tracing.trace("prerender"):
+                thought = await self._intelligence_registry.get_core(state.chat_id).conceive()
+        except Exception as ex:
+            self._log.error("Failed to prerender a thought for chat {}: {}".format(state.chat_id, ex))
+            thought = None
+        if not next_thought.done():
+            next_thought.set_result(thought)
 
     def _randomize_conceive_interval(self):
         return datetime.timedelta(seconds=random.uniform(0, self._conceive_interval.total_seconds()))
 
-    async def _send_thought(self, thought):
+    async def _send_thought(self, thought, state, urgency=Urgency.REPLY):
+        _THOUGHTS_SENT.labels(urgency.name, thought.thought_type.name).inc()
         if thought.thought_type == ThoughtType.TEXT:
-            await self.sender.sendMessage(thought.payload)
+            await state.sender.sendMessage(thought.payload, urgency=urgency)
         elif thought.thought_type == ThoughtType.SPEECH:
-            await self.sender.sendVoice(
+            await state.sender.sendVoice(
                 thought.payload["speech_data"],
+                urgency=urgency,
                 reply_markup=InlineButton(
                     text="Read",
-                    callback_data=self._callback_query.register_handler(
+                    callback_data=state.callback_query.register_handler(
                         functools.partial(
                             self._read_voice_message_handler, voice_text=thought.payload["text"]
                         )
@@ -0,0 +1,357 @@
+import array
+import bisect
+import io
+import itertools
+import json
+import mmap
+import operator
+import random
+import struct
+import sys
+import threading
+
+import attr
+from markovify.chain import BEGIN, END
+from markovify.text import DEFAULT_MAX_OVERLAP_RATIO, DEFAULT_MAX_OVERLAP_TOTAL
+
+from markov_model import SENTENCE_PARSER, STATE_SIZE, parse_sentences
+from util.atomic_file import atomic_write
+
+_BEGIN_ID = 0
+_END_ID = 1
+
+_KEY_BITS = 64
+
+_SNAPSHOT_MAGIC = b"BLABMARK"
+_SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER_LENGTH = struct.Struct("<Q")
+_SNAPSHOT_ALIGNMENT = 8
+
+_TABLE_FIELDS = ("state_keys", "offsets", "successors", "cumulative_weights")
+
+
+def _raw(buffer):
+    return memoryview(buffer).cast("B")
+
+
+def _aligned(offset):
+    return -(-offset // _SNAPSHOT_ALIGNMENT) * _SNAPSHOT_ALIGNMENT
+
+
+@attr.s(slots=True)
+class _MappedChunk:
+    _buffer = attr.ib()
+    _start = attr.ib()
+    _end = attr.ib()
+
+    def find(self, sub):
+        return self._buffer.find(sub, self._start, self._end)
+
+    def view(self):
+        return memoryview(self._buffer)[self._start : self._end]
+
+
+@attr.s(slots=True)
+class _Tables:
+    state_keys = attr.ib(factory=lambda: array.array("Q"))
+    offsets = attr.ib(factory=lambda: array.array("Q", [0]))
+    successors = attr.ib(factory=lambda: array.array("I"))
+    cumulative_weights = attr.ib(factory=lambda: array.array("Q"))
+
+    def __len__(self):
+        return len(self.successors)
+
+    def lookup(self, state_key):
+        index = bisect.bisect_left(self.state_keys, state_key)
+        if index == len(self.state_keys) or self.state_keys[index] != state_key:
+            return 0, 0, 0
+        low, high = self.offsets[index], self.offsets[index + 1]
+        return self.cumulative_weights[high - 1], low, high
+
+    def byte_views(self):
+        # Offsets are viewed as the lengths of the states, so ranges of them can be copied as they are
+        lengths = array.array("Q", map(operator.sub, self.offsets[1:], self.offsets[:-1]))
+        return tuple(
+            _raw(buffer) for buffer in (self.state_keys, lengths, self.successors, self.cumulative_weights)
+        )
+
+    def copy_states(self, source, source_views, start, end):
+        # Offsets of tables being merged hold the lengths of their states until the merge is finished
+        low, high = source.offsets[start], source.offsets[end]
+        state_keys, lengths, successors, cumulative_weights = source_views
+        state_keys_size, offsets_size = self.state_keys.itemsize, self.offsets.itemsize
+        successors_size, weights_size = self.successors.itemsize, self.cumulative_weights.itemsize
+        self.state_keys.frombytes(state_keys[start * state_keys_size : end * state_keys_size])
+        self.offsets.frombytes(lengths[start * offsets_size : end * offsets_size])
+        self.successors.frombytes(successors[low * successors_size : high * successors_size])
+        self.cumulative_weights.frombytes(cumulative_weights[low * weights_size : high * weights_size])
+
+    def finish_merge(self):
+        self.offsets = array.array("Q", itertools.chain((0,), itertools.accumulate(self.offsets)))
+
+    def followers(self, index):
+        low, high = self.offsets[index], self.offsets[index + 1]
+        previous = 0
+        for position in range(low, high):
+            weight = self.cumulative_weights[position]
+            yield self.successors[position], weight - previous
+            previous = weight
+
+
+@attr.s(slots=True)
+class CompactMarkovModel:
+    _COMPACTION_RATIO = 0.25
+    _BUILD_COMPACTION_RATIO = 1.0
+
+    _state_size = attr.ib(default=STATE_SIZE)
+    _compaction_ratio = attr.ib(default=_COMPACTION_RATIO)
+    _vocabulary = attr.ib(factory=lambda: [BEGIN, END])
+    _word_ids = attr.ib(factory=lambda: {BEGIN: _BEGIN_ID, END: _END_ID})
+    _tables = attr.ib(factory=_Tables)
+    _delta = attr.ib(factory=dict)
+    _delta_size = attr.ib(default=0)
+    _corpus = attr.ib(factory=list)
+    _lock = attr.ib(factory=threading.Lock)
+
+    @classmethod
+    def build(cls, batches):
+        # Every merge copies the whole tables, so a build lets the delta grow as large as them between merges
+        model = cls(compaction_ratio=cls._BUILD_COMPACTION_RATIO)
+        for sentences in batches:
+            model.extend(sentences)
+        with model._lock:
+            model._compact()
+            model._corpus = [b" ".join(model._corpus)]
+            model._compaction_ratio = cls._COMPACTION_RATIO
+        return model
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as fd:
+            return cls._from_buffer(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @classmethod
+    def loads(cls, data):
+        return cls._from_buffer(data)
+
+    @property
+    def transition_count(self):
+        # Delta entries are counted per occurrence, so this overestimates until the next compaction
+        return len(self._tables) + self._delta_size
+
+    def dump(self, path, metadata):
+        with atomic_write(path, "wb") as fd:
+            self._write(fd, metadata)
+
+    def dumps(self, metadata):
+        fd = io.BytesIO()
+        self._write(fd, metadata)
+        return fd.getvalue()
+
+    @classmethod
+    def _from_buffer(cls, buffer):
+        if buffer[: len(_SNAPSHOT_MAGIC)] != _SNAPSHOT_MAGIC:
+            raise ValueError("Buffer is not a Markov model snapshot")
+
+        header_start = len(_SNAPSHOT_MAGIC) + _SNAPSHOT_HEADER_LENGTH.size
+        (header_length,) = _SNAPSHOT_HEADER_LENGTH.unpack_from(buffer, len(_SNAPSHOT_MAGIC))
+        header = json.loads(buffer[header_start : header_start + header_length].decode())
+        if header["version"] != _SNAPSHOT_VERSION or header["byteorder"] != sys.byteorder:
+            raise ValueError("Snapshot has incompatible format")
+
+        data_start = _aligned(header_start + header_length)
+        sections = {
+            name: (data_start + offset, data_start + offset + length, typecode)
+            for name, (offset, length, typecode) in header["sections"].items()
+        }
+        view = memoryview(buffer)
+        tables = _Tables(
+            **{
+                name: view[start:end].cast(typecode)
+                for name, (start, end, typecode) in sections.items()
+                if name in _TABLE_FIELDS
+            }
+        )
+        corpus_start, corpus_end, _ = sections["corpus"]
+
+        model = cls(
+            state_size=header["state_size"],
+            vocabulary=header["vocabulary"],
+            word_ids=None,
+            tables=tables,
+            corpus=[_MappedChunk(buffer, corpus_start, corpus_end)],
+        )
+        return model, header["metadata"]
+
+    def _write(self, fd, metadata):
+        with self._lock:
+            self._compact()
+
+            buffers = [(name, memoryview(getattr(self._tables, name))) for name in _TABLE_FIELDS]
+            corpus = [chunk.view() if isinstance(chunk, _MappedChunk) else chunk for chunk in self._corpus]
+
+            sections = {}
+            offset = 0
+            for name, buffer in buffers:
+                sections[name] = (offset, buffer.nbytes, buffer.format)
+                offset = _aligned(offset + buffer.nbytes)
+            corpus_length = sum(len(chunk) for chunk in corpus) + max(len(corpus) - 1, 0)
+            sections["corpus"] = (offset, corpus_length, "B")
+
+            header = json.dumps(
+                {
+                    "version": _SNAPSHOT_VERSION,
+                    "byteorder": sys.byteorder,
+                    "state_size": self._state_size,
+                    "vocabulary": self._vocabulary,
+                    "sections": sections,
+                    "metadata": metadata,
+                }
+            ).encode()
+
+            fd.write(_SNAPSHOT_MAGIC)
+            fd.write(_SNAPSHOT_HEADER_LENGTH.pack(len(header)))
+            fd.write(header)
+            for _, buffer in buffers:
+                fd.seek(_aligned(fd.tell()))
+                fd.write(buffer)
+            fd.seek(_aligned(fd.tell()))
+            fd.write(b" ".join(corpus))
+
+    def extend(self, sentences):
+        runs = parse_sentences(sentences)
+        if not runs:
+            return
+
+        with self._lock:
+            for run in runs:
+                self._count_transitions(self._tokenize(run))
+            self._corpus.append(
+                SENTENCE_PARSER.word_join(SENTENCE_PARSER.word_join(run) for run in runs).encode()
+            )
+
+            if self._delta_size > max(len(self._tables), 1) * self._compaction_ratio:
+                self._compact()
+
+    def make_sentence(self, tries):
+        with self._lock:
+            for _ in range(tries):
+                words = [self._vocabulary[token] for token in self._walk()]
+                if words and self._test_sentence_output(words):
+                    return SENTENCE_PARSER.word_join(words)
+            return None
+
+    @property
+    def _key_bits(self):
+        return _KEY_BITS // self._state_size
+
+    def _tokenize(self, words):
+        if self._word_ids is None:
+            self._word_ids = {word: token for token, word in enumerate(self._vocabulary)}
+
+        tokens = [self._word_ids.get(word) for word in words]
+        if None in tokens:
+            tokens = [self._intern(word) if token is None else token for word, token in zip(words, tokens)]
+        return tokens
+
+    def _intern(self, word):
+        token = self._word_ids.get(word)
+        if token is None:
+            token = len(self._vocabulary)
+            if token >> self._key_bits:
+                raise OverflowError("Vocabulary does not fit into state key")
+            self._vocabulary.append(word)
+            self._word_ids[word] = token
+        return token
+
+    def _advance(self, state_key, token):
+        return (state_key >> self._key_bits) | (token << (self._key_bits * (self._state_size - 1)))
+
+    def _count_transitions(self, tokens):
+        # This runs for every learned word, so the state advance is inlined
+        key_bits = self._key_bits
+        shift = key_bits * (self._state_size - 1)
+        delta = self._delta
+        state_key = _BEGIN_ID
+        for token in tokens + [_END_ID]:
+            followers = delta.get(state_key)
+            if followers is None:
+                followers = delta[state_key] = {}
+            followers[token] = followers.get(token, 0) + 1
+            state_key = (state_key >> key_bits) | (token << shift)
+        self._delta_size += len(tokens) + 1
+
+    def _compact(self):
+        if not self._delta:
+            return
+
+        tables = self._tables
+        views = tables.byte_views()
+        merged = _Tables(offsets=array.array("Q"))
+        position = 0
+        for state_key in sorted(self._delta):
+            index = bisect.bisect_left(tables.state_keys, state_key, position)
+            if index > position:
+                merged.copy_states(tables, views, position, index)
+
+            followers = self._delta[state_key]
+            if index < len(tables.state_keys) and tables.state_keys[index] == state_key:
+                frozen_followers = dict(tables.followers(index))
+                for token, count in followers.items():
+                    frozen_followers[token] = frozen_followers.get(token, 0) + count
+                followers = frozen_followers
+                index += 1
+            self._append_state(merged, state_key, followers)
+            position = index
+        if position < len(tables.state_keys):
+            merged.copy_states(tables, views, position, len(tables.state_keys))
+        merged.finish_merge()
+
+        self._tables = merged
+        self._delta = {}
+        self._delta_size = 0
+
+    @staticmethod
+    def _append_state(tables, state_key, followers):
+        tables.state_keys.append(state_key)
+        tables.offsets.append(len(followers))
+        tables.successors.extend(followers)
+        tables.cumulative_weights.extend(itertools.accumulate(followers.values()))
+
+    def _move(self, state_key):
+        frozen_total, low, high = self._tables.lookup(state_key)
+        followers = self._delta.get(state_key, {})
+
+        total = frozen_total + sum(followers.values())
+        if not total:
+            return _END_ID
+
+        choice = random.randrange(total)
+        if choice < frozen_total:
+            return self._tables.successors[
+                bisect.bisect_right(self._tables.cumulative_weights, choice, low, high)
+            ]
+
+        choice -= frozen_total
+        for token, count in followers.items():
+            if choice < count:
+                return token
+            choice -= count
+        raise AssertionError("Weights are inconsistent")
+
+    def _walk(self):
+        state_key = _BEGIN_ID
+        while True:
+            token = self._move(state_key)
+            if token == _END_ID:
+                return
+            yield token
+            state_key = self._advance(state_key, token)
+
+    def _test_sentence_output(self, words):
+        overlap_max = min(DEFAULT_MAX_OVERLAP_TOTAL, round(DEFAULT_MAX_OVERLAP_RATIO * len(words)))
+        for i in range(max(len(words) - overlap_max, 1)):
+            gram = SENTENCE_PARSER.word_join(words[i : i + overlap_max + 1]).encode()
+            if any(chunk.find(gram) != -1 for chunk in self._corpus):
+                return False
+        return True
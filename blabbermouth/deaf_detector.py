@@ -1,10 +1,11 @@
+import functools
 import re
 
 import attr
-import telepot
 
 from util.chain import chained, check, not_none
 from util.log import logged
+from work_scheduler import Priority, WorkScheduler
 
 
 @logged
@@ -84,23 +85,22 @@ class DeafDetector:
         return self.TO_THIRD_CONVERSION_MAP.get(word.lower(), word)
 
 
-@logged
-class DeafDetectorHandler(telepot.aio.helper.ChatHandler):
-    def __init__(self, *args, event_loop, **kwargs):
-        super(DeafDetectorHandler, self).__init__(*args, **kwargs)
-
-        self._event_loop = event_loop
-        self._backend = DeafDetector()
+@attr.s(slots=True)
+class DeafDetectorStage:
+    _work_scheduler = attr.ib(validator=attr.validators.instance_of(WorkScheduler))
 
-        self._log.info("Created {}".format(id(self)))
+    def open(self, state):
+        pass
 
-    async def on_chat_message(self, message):
-        self._event_loop.create_task(self._on_chat_message(message))
+    async def on_message(self, glance, state):
+        answer = state.deaf_detector.try_reply(glance.message)
+        if answer is None:
+            return
 
-    @chained
-    async def _on_chat_message(self, message):
-        answer = not_none(self._backend.try_reply(message))
-        await self.sender.sendMessage("_{}_".format(answer), parse_mode="Markdown")
+        self._work_scheduler.submit(
+            state.chat_id, Priority.REPLY, functools.partial(self._reply, "_{}_".format(answer), state)
+        )
 
-    def on__idle(self, _):
-        self._log.debug("Ignoring on__idle")
+    async def _reply(self, answer, state):
+        # The sender returns a future of the delivery, work has to be a coroutine
+        await state.sender.sendMessage(answer, parse_mode="Markdown")
@@ -0,0 +1,128 @@
+import time
+import types
+
+import aiohttp
+import attr
+
+from util import metrics
+from util.log import logged
+
+_IN_FLIGHT = metrics.gauge("blabbermouth_http_in_flight", "Outbound HTTP requests in progress")
+_POOL_UTILIZATION = metrics.gauge("blabbermouth_http_pool_utilization", "Share of the connection pool in use")
+_QUEUED = metrics.gauge("blabbermouth_http_queued", "Outbound HTTP requests waiting for a connection")
+_CONNECTIONS = metrics.counter("blabbermouth_http_connections_total", "Pooled connections by kind", ["kind"])
+_REQUEST_SECONDS = metrics.histogram(
+    "blabbermouth_http_request_seconds", "Outbound HTTP request latency", ["host", "outcome"]
+)
+
+
+@attr.s(slots=True)
+class EndpointStats:
+    requests = attr.ib(default=0)
+    failures = attr.ib(default=0)
+    total_latency = attr.ib(default=0.0)
+    max_latency = attr.ib(default=0.0)
+
+    def record(self, latency, failed):
+        self.requests += 1
+        self.failures += failed
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+
+@logged
+@attr.s(slots=True)
+class HttpClient:
+    _limit = attr.ib()
+    session = attr.ib(default=None)
+    endpoints = attr.ib(factory=dict)
+    in_flight = attr.ib(default=0)
+    queued = attr.ib(default=0)
+    queue_wait = attr.ib(default=0.0)
+    connections_created = attr.ib(default=0)
+    connections_reused = attr.ib(default=0)
+
+    @classmethod
+    def build(
+        cls,
+        limit,
+        limit_per_host,
+        keepalive_timeout,
+        dns_cache_ttl,
+        total_timeout,
+        connect_timeout,
+        read_timeout,
+    ):
+        client = cls(limit=limit)
+        _IN_FLIGHT.set_function(lambda: client.in_flight)
+        _POOL_UTILIZATION.set_function(lambda: client.utilization)
+        _QUEUED.set_function(lambda: client.queued)
+        _CONNECTIONS.labels("created").set_function(lambda: client.connections_created)
+        _CONNECTIONS.labels("reused").set_function(lambda: client.connections_reused)
+        client.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=limit,
+                limit_per_host=limit_per_host,
+                keepalive_timeout=keepalive_timeout,
+                ttl_dns_cache=dns_cache_ttl,
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=total_timeout, sock_connect=connect_timeout, sock_read=read_timeout
+            ),
+            trace_configs=[client._trace_config()],
+        )
+        return client
+
+    @property
+    def utilization(self):
+        return self.in_flight / self._limit
+
+    async def close(self):
+        await self.session.close()
+        self._log.info("Closed HTTP session")
+
+    def _trace_config(self):
+        trace_config = aiohttp.TraceConfig(trace_config_ctx_factory=self._trace_context)
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_request_end.append(self._on_request_end)
+        trace_config.on_request_exception.append(self._on_request_exception)
+        trace_config.on_connection_queued_start.append(self._on_connection_queued_start)
+        trace_config.on_connection_queued_end.append(self._on_connection_queued_end)
+        trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+        return trace_config
+
+    @staticmethod
+    def _trace_context(trace_request_ctx):
+        return types.SimpleNamespace(trace_request_ctx=trace_request_ctx, started_at=None, queued_at=None)
+
+    async def _on_request_start(self, session, context, params):
+        self.in_flight += 1
+        context.started_at = time.monotonic()
+
+    async def _on_request_end(self, session, context, params):
+        self._finish_request(context, params.url, failed=params.response.status >= 400)
+
+    async def _on_request_exception(self, session, context, params):
+        self._finish_request(context, params.url, failed=True)
+
+    def _finish_request(self, context, url, failed):
+        self.in_flight -= 1
+        # Endpoints are hosts, paths such as subreddits would make the stats unbounded
+        latency = time.monotonic() - context.started_at
+        self.endpoints.setdefault(url.host, EndpointStats()).record(latency, failed)
+        _REQUEST_SECONDS.labels(url.host, "failed" if failed else "ok").observe(latency)
+
+    async def _on_connection_queued_start(self, session, context, params):
+        self.queued += 1
+        context.queued_at = time.monotonic()
+
+    async def _on_connection_queued_end(self, session, context, params):
+        self.queued -= 1
+        self.queue_wait += time.monotonic() - context.queued_at
+
+    async def _on_connection_create_end(self, session, context, params):
+        self.connections_created += 1
+
+    async def _on_connection_reuseconn(self, session, context, params):
+        self.connections_reused += 1
@@ -1,51 +1,150 @@
+import concurrent.futures
 import datetime
+import multiprocessing
+import os
 
 from yandex_speech_client import Emotion as SpeechEmotion
 from yandex_speech_client import YandexSpeechClient
 
-from aggregating_intelligence_core import AggregatingIntelligenceCore
-from markov_chain_intelligence_core import MarkovChainIntelligenceCore
+from aggregating_intelligence_core import AggregatingIntelligenceCore, CoreHealth
+from compact_markov_model import CompactMarkovModel
+from markov_chain_intelligence_core import MarkovChainIntelligenceCore, MarkovTextRegistry
+from markov_model import MarkovifyModel
+from markov_worker import ProcessMarkovWorker, ThreadMarkovWorker
+from rebuild_scheduler import RebuildScheduler
 from reddit_browser import RedditBrowser
 from reddit_browser import FeedSortType as RedditFeedSortType
 from reddit_chatter import RedditChatter
 from speaking_intelligence_core import SpeakingIntelligenceCore
+from speech_cache import CachingSpeechClient
+from util.circuit_breaker import CircuitBreaker
 
+MARKOV_MODEL_BACKENDS = {"markovify": MarkovifyModel, "compact": CompactMarkovModel}
 
-def build(chat_id, event_loop, knowledge_base, http_session, user_agent, markov_chain_worker, conf):
-    markov_chain_core = MarkovChainIntelligenceCore.build(
+
+def build_markov_worker(event_loop, conf):
+    worker_count = conf["markov_chain_intelligence_core"]["worker_count"] or os.cpu_count()
+    thread_worker = ThreadMarkovWorker(
+        event_loop=event_loop, executor=concurrent.futures.ThreadPoolExecutor(max_workers=worker_count)
+    )
+    if conf["markov_chain_intelligence_core"]["worker_mode"] == "thread":
+        return thread_worker
+    return ProcessMarkovWorker(
+        event_loop=event_loop,
+        executor=concurrent.futures.ProcessPoolExecutor(max_workers=worker_count),
+        thread_worker=thread_worker,
+        manager=multiprocessing.Manager(),
+    )
+
+
+def build_markov_text_registry(event_loop, knowledge_base, learning_feed, markov_chain_worker, conf):
+    return MarkovTextRegistry.build(
         event_loop=event_loop,
         worker=markov_chain_worker,
-        chat_id=chat_id,
+        rebuild_scheduler=RebuildScheduler(
+            concurrency=conf["markov_chain_intelligence_core"]["rebuild_concurrency"]
+        ),
         knowledge_base=knowledge_base,
+        learning_feed=learning_feed,
+        model_class=MARKOV_MODEL_BACKENDS[conf["markov_chain_intelligence_core"]["model_backend"]],
+        snapshot_directory=conf["markov_chain_intelligence_core"]["snapshot_directory"],
         knowledge_lifespan=datetime.timedelta(
             minutes=conf["markov_chain_intelligence_core"]["knowledge_lifespan_minutes"]
         ),
+        compaction_lifespan=datetime.timedelta(
+            hours=conf["markov_chain_intelligence_core"]["compaction_lifespan_hours"]
+        ),
+        refresh_jitter=conf["markov_chain_intelligence_core"]["refresh_jitter"],
         make_sentence_attempts=conf["markov_chain_intelligence_core"]["make_sentence_attempts"],
+        ingestion_batch_size=conf["markov_chain_intelligence_core"]["ingestion_batch_size"],
+        sentence_concurrency=conf["markov_chain_intelligence_core"]["sentence_concurrency"],
+        sentence_queue_depth=conf["markov_chain_intelligence_core"]["sentence_queue_depth"],
+        sentence_wait_timeout=conf["markov_chain_intelligence_core"]["sentence_wait_timeout_seconds"],
+        sentence_pool_size=conf["markov_chain_intelligence_core"]["sentence_pool_size"],
+        sentence_pool_refill_threshold=conf["markov_chain_intelligence_core"][
+            "sentence_pool_refill_threshold"
+        ],
+        build_retry_delay=conf["markov_chain_intelligence_core"]["build_retry_delay_seconds"],
+        build_retry_max_delay=conf["markov_chain_intelligence_core"]["build_retry_max_delay_seconds"],
+        text_cache_size=conf["markov_chain_intelligence_core"]["text_cache_size"],
+        text_cache_idle_ttl=datetime.timedelta(
+            minutes=conf["markov_chain_intelligence_core"]["text_cache_idle_ttl_minutes"]
+        ),
+        text_cache_max_transitions=conf["markov_chain_intelligence_core"]["text_cache_max_transitions"],
     )
+
+
+def build_speech_client(event_loop, http_session, conf):
+    return CachingSpeechClient.build(
+        event_loop=event_loop,
+        speech_client=YandexSpeechClient(
+            http_session=http_session,
+            api_key=conf["yandex_dev_api_key"],
+            api_url=conf["yandex_speech_client"]["api_url"],
+        ),
+        directory=conf["speech_cache"]["directory"],
+        memory_size=conf["speech_cache"]["memory_size"],
+        memory_bytes=conf["speech_cache"]["memory_megabytes"] * 1024 * 1024,
+        memory_idle_ttl=datetime.timedelta(minutes=conf["speech_cache"]["memory_idle_ttl_minutes"]),
+        max_disk_entries=conf["speech_cache"]["max_disk_entries"],
+        timeout=conf["speech_cache"]["timeout_seconds"],
+        concurrency=conf["speech_cache"]["concurrency"],
+        retries=conf["speech_cache"]["retries"],
+    )
+
+
+def build_core_health(conf):
+    # Health is shared by the cores of every chat, a failing service is the same for all of them
+    return {
+        name: CoreHealth(
+            name=name,
+            weight=core_conf["weight"],
+            smoothing=conf["aggregating_intelligence_core"]["stats_smoothing"],
+            timeout=core_conf["timeout_seconds"],
+            breaker=CircuitBreaker(
+                failure_threshold=conf["aggregating_intelligence_core"]["failure_threshold"],
+                reset_timeout=conf["aggregating_intelligence_core"]["reset_timeout_seconds"],
+            ),
+        )
+        for name, core_conf in conf["aggregating_intelligence_core"]["cores"].items()
+    }
+
+
+def build_reddit_browser(event_loop, http_session, user_agent, conf):
+    return RedditBrowser.build(
+        event_loop=event_loop,
+        http_session=http_session,
+        reddit_url=conf["reddit_browser"]["reddit_url"],
+        user_agent=user_agent,
+        prefetch_limit=conf["reddit_browser"]["prefetch_limit"],
+        feed_lifespan=datetime.timedelta(minutes=conf["reddit_browser"]["feed_lifespan_minutes"]),
+        feed_jitter=conf["reddit_browser"]["feed_jitter"],
+        feed_cache_size=conf["reddit_browser"]["feed_cache_size"],
+    )
+
+
+def build(chat_id, markov_text_registry, speech_client, core_health, reddit_browser, conf):
+    markov_chain_core = MarkovChainIntelligenceCore(chat_id=chat_id, text_registry=markov_text_registry)
     return AggregatingIntelligenceCore(
-        cores=[
-            markov_chain_core,
-            SpeakingIntelligenceCore(
+        cores={
+            "markov": markov_chain_core,
+            "speech": SpeakingIntelligenceCore(
                 text_core=markov_chain_core,
-                speech_client=YandexSpeechClient(
-                    http_session=http_session,
-                    api_key=conf["yandex_dev_api_key"],
-                    api_url=conf["yandex_speech_client"]["api_url"],
-                ),
+                speech_client=speech_client,
                 voice=conf["speaking_intelligence_core"]["voice"],
                 lang=conf["speaking_intelligence_core"]["lang"],
                 audio_format=conf["speaking_intelligence_core"]["audio_format"],
                 emotions=list(SpeechEmotion),
             ),
-            RedditChatter(
-                reddit_browser=RedditBrowser.build(
-                    http_session=http_session,
-                    reddit_url=conf["reddit_browser"]["reddit_url"],
-                    user_agent=user_agent,
-                ),
+            "reddit": RedditChatter(
+                reddit_browser=reddit_browser,
                 top_post_comments=conf["reddit_chatter"]["top_post_comments"],
                 subreddits_of_interest=conf["reddit_chatter"]["subreddits_of_interest"],
+                remembered_posts=conf["reddit_chatter"]["remembered_posts"],
                 sort_types=[RedditFeedSortType.BEST, RedditFeedSortType.HOT, RedditFeedSortType.TOP],
             ),
-        ]
+        },
+        health=core_health,
+        deadline=conf["aggregating_intelligence_core"]["deadline_seconds"],
+        hedge_delay=conf["aggregating_intelligence_core"]["hedge_delay_seconds"],
     )
@@ -7,13 +7,25 @@ class KnowledgeBase(abc.ABC):
         pass
 
     @abc.abstractmethod
-    async def select_by_full_knowledge(self):
+    async def open(self):
         pass
 
     @abc.abstractmethod
-    async def select_by_chat(self, chat_id):
+    async def close(self):
         pass
 
     @abc.abstractmethod
-    async def select_by_user(self, user):
+    async def last_record_id(self):
+        pass
+
+    @abc.abstractmethod
+    async def select_by_full_knowledge(self, since=None, until=None):
+        pass
+
+    @abc.abstractmethod
+    async def select_by_chat(self, chat_id, since=None, until=None):
+        pass
+
+    @abc.abstractmethod
+    async def select_by_user(self, user, since=None, until=None):
         pass
@@ -0,0 +1,29 @@
+from memory_knowledge_base import MemoryKnowledgeBase
+from mongo_knowledge_base import MongoKnowledgeBase
+from sqlite_knowledge_base import SqliteKnowledgeBase
+
+
+def build(event_loop, conf):
+    backend = conf["core"]["knowledge_base"]
+    if backend == "mongo":
+        return MongoKnowledgeBase.build(
+            host=conf["mongo_knowledge_base"]["db_host"],
+            port=conf["mongo_knowledge_base"]["db_port"],
+            db_name=conf["mongo_knowledge_base"]["db_name"],
+            db_collection=conf["mongo_knowledge_base"]["db_collection"],
+            write_batch_size=conf["mongo_knowledge_base"]["write_batch_size"],
+            write_flush_interval=conf["mongo_knowledge_base"]["write_flush_interval_seconds"],
+            write_queue_depth=conf["mongo_knowledge_base"]["write_queue_depth"],
+            write_retries=conf["mongo_knowledge_base"]["write_retries"],
+            write_retry_delay=conf["mongo_knowledge_base"]["write_retry_delay_seconds"],
+            read_batch_size=conf["mongo_knowledge_base"]["read_batch_size"],
+        )
+    if backend == "sqlite":
+        return SqliteKnowledgeBase.build(
+            event_loop=event_loop,
+            path=conf["sqlite_knowledge_base"]["db_path"],
+            read_batch_size=conf["sqlite_knowledge_base"]["read_batch_size"],
+        )
+    if backend == "memory":
+        return MemoryKnowledgeBase()
+    raise ValueError("Unknown knowledge base backend: {}".format(backend))
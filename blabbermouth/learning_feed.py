@@ -0,0 +1,31 @@
+import collections
+import weakref
+
+import attr
+
+CHAT_SCOPE = "chat"
+USER_SCOPE = "user"
+FULL_KNOWLEDGE_SCOPE = "full_knowledge"
+
+FULL_KNOWLEDGE_KEY = (FULL_KNOWLEDGE_SCOPE,)
+
+
+def chat_key(chat_id):
+    return (CHAT_SCOPE, chat_id)
+
+
+def user_key(user):
+    return (USER_SCOPE, user)
+
+
+@attr.s(slots=True)
+class LearningFeed:
+    _listeners = attr.ib(factory=lambda: collections.defaultdict(weakref.WeakValueDictionary))
+
+    def subscribe(self, key, listener):
+        self._listeners[key][id(listener)] = listener
+
+    def publish(self, record_id, chat_id, user, text):
+        for key in (chat_key(chat_id), user_key(user), FULL_KNOWLEDGE_KEY):
+            for listener in list(self._listeners.get(key, {}).values()):
+                listener.learn(record_id, text)
@@ -1,41 +1,38 @@
-import telepot
-
-from knowledge_base import KnowledgeBase
-from util.log import logged
+import functools
 
+import attr
 
-@logged
-class LearningHandler(telepot.aio.helper.ChatHandler):
-    def __init__(self, *args, knowledge_base, self_reference_detector, bot_name, event_loop, **kwargs):
-        if not isinstance(knowledge_base, KnowledgeBase):
-            raise TypeError("knowledge_base must be KnowledgeBase")
+from knowledge_base import KnowledgeBase
+from util import metrics
+from work_scheduler import Priority, WorkScheduler
 
-        super(LearningHandler, self).__init__(*args, **kwargs)
+_LEARNED = metrics.counter("blabbermouth_messages_learned_total", "Chat messages recorded as knowledge")
 
-        self._knowledge_base = knowledge_base
-        self._self_reference_detector = self_reference_detector
-        self._bot_name = bot_name
-        self._event_loop = event_loop
 
-        self._log.info("Created {}".format(id(self)))
+@attr.s(slots=True)
+class LearningStage:
+    _knowledge_base = attr.ib(validator=attr.validators.instance_of(KnowledgeBase))
+    _learning_feed = attr.ib()
+    _bot_name = attr.ib()
+    _work_scheduler = attr.ib(validator=attr.validators.instance_of(WorkScheduler))
 
-    async def on_chat_message(self, message):
-        self._event_loop.create_task(self._on_chat_message(message))
+    def open(self, state):
+        pass
 
-    async def _on_chat_message(self, message):
-        text = message.get("text")
-        if text is None:
+    async def on_message(self, glance, state):
+        if glance.text is None or glance.user is None:
             return
-        if self._self_reference_detector(message):
+        if glance.is_self_reference or glance.user == self._bot_name:
             return
 
-        user = message["from"]["username"]
-        if user == self._bot_name:
-            return
-
-        chat_id = message["chat"]["id"]
-
-        await self._knowledge_base.record(chat_id=chat_id, user=user, text=text)
-
-    def on__idle(self, _):
-        self._log.debug("Ignoring on__idle")
+        # Learning is the first work to be dropped when the bot is overloaded
+        self._work_scheduler.submit(
+            state.chat_id,
+            Priority.LEARNING,
+            functools.partial(self._learn, state.chat_id, glance.user, glance.text),
+        )
+
+    async def _learn(self, chat_id, user, text):
+        record_id = await self._knowledge_base.record(chat_id=chat_id, user=user, text=text)
+        self._learning_feed.publish(record_id=record_id, chat_id=chat_id, user=user, text=text)
+        _LEARNED.inc()
@@ -1,9 +1,10 @@
 import argparse
 import asyncio
-import concurrent.futures
+import contextlib
+import datetime
 import functools
+import signal
 
-import aiohttp
 import attr
 import telepot
 from telepot.aio.loop import MessageLoop
@@ -11,8 +12,17 @@ from telepot.aio.loop import MessageLoop
 import bot_factory
 import chat_intelligence
 import intelligence_core_factory
-from mongo_knowledge_base import MongoKnowledgeBase
-from util import config, log
+import knowledge_base_factory
+from http_client import HttpClient
+from learning_feed import LearningFeed
+from metrics_server import MetricsServer
+from outbound_dispatcher import BotTransport, OutboundDispatcher
+from util import config, log, metrics, tracing
+from util.profiling import LoopLagMonitor, SamplingProfiler
+from webhook_server import WebhookServer
+from work_scheduler import WorkScheduler
+
+_EVENT_LOOP_TASKS = metrics.gauge("blabbermouth_event_loop_tasks", "Tasks alive on the event loop")
 
 
 @attr.s(slots=True)
@@ -35,6 +45,45 @@ def parse_args():
     return parser.parse_args()
 
 
+def start_profiling(event_loop, conf):
+    tracing.TRACER.sample_rate = conf["profiling"]["trace_sample_rate"]
+    tracing.TRACER.slow_threshold = conf["profiling"]["slow_trace_seconds"]
+
+    # Debug mode reports every slow callback by name, but slows the whole loop down
+    if conf["profiling"]["loop_debug"]:
+        event_loop.set_debug(True)
+        event_loop.slow_callback_duration = conf["profiling"]["slow_callback_seconds"]
+
+    lag_monitor = LoopLagMonitor(
+        event_loop=event_loop,
+        interval=conf["profiling"]["loop_lag_interval_seconds"],
+        threshold=conf["profiling"]["slow_callback_seconds"],
+    )
+    lag_monitor.start()
+
+    profiler = SamplingProfiler(
+        directory=conf["profiling"]["directory"],
+        capture_duration=conf["profiling"]["capture_seconds"],
+        capture_interval=conf["profiling"]["capture_interval_minutes"] * 60,
+    )
+    profiler.start()
+    event_loop.add_signal_handler(signal.SIGUSR1, profiler.capture)
+    return profiler, lag_monitor
+
+
+def build_update_source(bot, conf):
+    if conf["core"]["update_source"] == "webhook":
+        return WebhookServer(
+            bot=bot,
+            host=conf["webhook_server"]["host"],
+            port=conf["webhook_server"]["port"],
+            path=conf["webhook_server"]["path"],
+            public_url=conf["webhook_server"]["public_url"],
+            max_connections=conf["webhook_server"]["max_connections"],
+        )
+    return MessageLoop(bot)
+
+
 async def main(event_loop):
     args = parse_args()
     config_env_overrides = {
@@ -48,46 +97,118 @@ async def main(event_loop):
 
     telepot.aio.api.set_proxy(conf["core"]["proxy"])
 
-    knowledge_base = MongoKnowledgeBase.build(
-        host=conf["mongo_knowledge_base"]["db_host"],
-        port=conf["mongo_knowledge_base"]["db_port"],
-        db_name=conf["mongo_knowledge_base"]["db_name"],
-        db_collection=conf["mongo_knowledge_base"]["db_collection"],
+    profiler, lag_monitor = start_profiling(event_loop, conf)
+
+    _EVENT_LOOP_TASKS.set_function(lambda: len(asyncio.all_tasks(event_loop)))
+    metrics_server = MetricsServer(
+        registry=metrics.REGISTRY,
+        host=conf["metrics"]["host"],
+        port=conf["metrics"]["port"],
+        path=conf["metrics"]["path"],
     )
+    if conf["metrics"]["enabled"]:
+        await metrics_server.start()
+
+    knowledge_base = knowledge_base_factory.build(event_loop=event_loop, conf=conf)
+    await knowledge_base.open()
+
+    learning_feed = LearningFeed()
 
-    intelligence_registry = chat_intelligence.IntelligenceRegistry(
+    markov_text_registry = intelligence_core_factory.build_markov_text_registry(
+        event_loop=event_loop,
+        knowledge_base=knowledge_base,
+        learning_feed=learning_feed,
+        markov_chain_worker=intelligence_core_factory.build_markov_worker(event_loop=event_loop, conf=conf),
+        conf=conf,
+    )
+
+    http_client = HttpClient.build(
+        limit=conf["http_client"]["limit"],
+        limit_per_host=conf["http_client"]["limit_per_host"],
+        keepalive_timeout=conf["http_client"]["keepalive_timeout_seconds"],
+        dns_cache_ttl=conf["http_client"]["dns_cache_ttl_seconds"],
+        total_timeout=conf["http_client"]["total_timeout_seconds"],
+        connect_timeout=conf["http_client"]["connect_timeout_seconds"],
+        read_timeout=conf["http_client"]["read_timeout_seconds"],
+    )
+
+    intelligence_registry = chat_intelligence.IntelligenceRegistry.build(
         core_constructor=functools.partial(
             intelligence_core_factory.build,
-            event_loop=event_loop,
-            knowledge_base=knowledge_base,
-            http_session=aiohttp.ClientSession(),
-            user_agent=conf["core"]["user_agent"],
-            markov_chain_worker=concurrent.futures.ThreadPoolExecutor(max_workers=5),
+            markov_text_registry=markov_text_registry,
+            speech_client=intelligence_core_factory.build_speech_client(
+                event_loop=event_loop, http_session=http_client.session, conf=conf
+            ),
+            core_health=intelligence_core_factory.build_core_health(conf),
+            reddit_browser=intelligence_core_factory.build_reddit_browser(
+                event_loop=event_loop,
+                http_session=http_client.session,
+                user_agent=conf["core"]["user_agent"],
+                conf=conf,
+            ),
             conf=conf,
-        )
+        ),
+        cache_size=conf["chat_intelligence"]["core_cache_size"],
+        cache_idle_ttl=datetime.timedelta(hours=conf["chat_intelligence"]["core_cache_idle_ttl_hours"]),
+    )
+
+    work_scheduler = WorkScheduler(
+        event_loop=event_loop,
+        concurrency=conf["work_scheduler"]["concurrency"],
+        reply_reserve=conf["work_scheduler"]["reply_reserve"],
+        chat_concurrency=conf["work_scheduler"]["chat_concurrency"],
+        queue_depth=conf["work_scheduler"]["queue_depth"],
+        chat_queue_depth=conf["work_scheduler"]["chat_queue_depth"],
     )
 
     bot_accessor = BotAccessor()
+
+    outbound_dispatcher = OutboundDispatcher.build(
+        event_loop=event_loop,
+        transport=BotTransport(bot_accessor=bot_accessor),
+        global_rate=conf["outbound_dispatcher"]["global_rate"],
+        chat_rate=conf["outbound_dispatcher"]["chat_rate"],
+        chat_burst=conf["outbound_dispatcher"]["chat_burst"],
+        chatter_stale_after=datetime.timedelta(
+            seconds=conf["outbound_dispatcher"]["chatter_stale_after_seconds"]
+        ),
+        max_retries=conf["outbound_dispatcher"]["max_retries"],
+        max_in_flight=conf["outbound_dispatcher"]["max_in_flight"],
+    )
+
     bot_accessor.set(
         bot_factory.build(
             bot_token=conf["token"],
             bot_name=conf["bot_name"],
             bot_accessor=bot_accessor,
-            event_loop=event_loop,
             intelligence_registry=intelligence_registry,
             knowledge_base=knowledge_base,
+            learning_feed=learning_feed,
+            work_scheduler=work_scheduler,
+            outbound_dispatcher=outbound_dispatcher,
             telepot_http_timeout=conf["telepot"]["http_timeout"],
             conf=conf,
         )
     )
 
-    await MessageLoop(bot_accessor()).run_forever()
+    try:
+        await build_update_source(bot_accessor(), conf).run_forever()
+    finally:
+        await http_client.close()
+        await knowledge_base.close()
+        await metrics_server.close()
+        profiler.stop()
+        lag_monitor.stop()
 
 
 def run_main():
     event_loop = asyncio.get_event_loop()
-    event_loop.create_task(main(event_loop))
-    event_loop.run_forever()
+    main_task = event_loop.create_task(main(event_loop))
+    # Stopping cancels the main task, so buffered records are flushed before exit
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        event_loop.add_signal_handler(signal_number, main_task.cancel)
+    with contextlib.suppress(asyncio.CancelledError):
+        event_loop.run_until_complete(main_task)
 
 
 if __name__ == "__main__":
@@ -1,116 +1,465 @@
-import contextlib
+import asyncio
+import collections
 import enum
 import functools
+import os
 import random
+import time
+import urllib.parse
 
 import attr
-import markovify
 
 import thought
 from intelligence_core import IntelligenceCore
 from knowledge_base import KnowledgeBase
+from learning_feed import (
+    CHAT_SCOPE,
+    FULL_KNOWLEDGE_KEY,
+    FULL_KNOWLEDGE_SCOPE,
+    USER_SCOPE,
+    chat_key,
+    user_key,
+)
+from rebuild_scheduler import RebuildScheduler
+from util.bounded_cache import BoundedCache
 from util.lifespan import Lifespan
+from util import metrics, tracing
 from util.log import logged
 
+_MODEL_JOB_SECONDS = metrics.histogram(
+    "blabbermouth_markov_job_seconds",
+    "Duration of Markov model jobs",
+    ["job"],
+    buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0),
+)
+_SENTENCES = metrics.counter(
+    "blabbermouth_markov_sentences_total", "Sentence requests by outcome", ["outcome"]
+)
+_SENTENCE_SECONDS = metrics.histogram("blabbermouth_markov_sentence_seconds", "Sentence generation latency")
+_TRANSITIONS = metrics.gauge("blabbermouth_markov_transitions", "Transitions of the cached Markov texts")
 
-async def _strip_dots(iterable):
+
+def _strip_dot(entry):
+    return entry[:-1] if entry.endswith(".") else entry
+
+
+async def _stripped_batches(iterable, batch_size):
+    batch = []
     async for entry in iterable:
-        if entry.endswith("."):
-            yield entry[:-1]
-        yield entry
+        batch.append(_strip_dot(entry))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 @logged
 @attr.s(slots=True)
 class CachedMarkovText:
+    _EXTENSION_WEIGHT = 0
+    _TOP_UP_WEIGHT = 1
+    _COMPACTION_WEIGHT = 2
+
+    _key = attr.ib()
     _event_loop = attr.ib()
     _worker = attr.ib()
+    _rebuild_scheduler = attr.ib(validator=attr.validators.instance_of(RebuildScheduler))
     _knowledge_source = attr.ib()
+    _knowledge_watermark = attr.ib()
+    _model_class = attr.ib()
+    _snapshot_path = attr.ib()
     _make_sentence_attempts = attr.ib()
-    _text_lifespan = attr.ib(converter=Lifespan)
-    _text = attr.ib(factory=lambda: markovify.Text("."))
-    _sentence_is_building = attr.ib(default=False)
+    _ingestion_batch_size = attr.ib()
+    _sentence_concurrency = attr.ib()
+    _sentence_queue_depth = attr.ib()
+    _sentence_wait_timeout = attr.ib()
+    _sentence_pool_size = attr.ib()
+    _sentence_pool_refill_threshold = attr.ib()
+    _build_retry_delay = attr.ib()
+    _build_retry_max_delay = attr.ib()
+    _text_lifespan = attr.ib(validator=attr.validators.instance_of(Lifespan))
+    _compaction_lifespan = attr.ib(validator=attr.validators.instance_of(Lifespan))
+    _on_model_change = attr.ib(default=None)
+    _model = attr.ib(default=None)
+    _last_demand = attr.ib(default=0.0)
+    _last_record_id = attr.ib(default=None)
+    _pending_knowledge = attr.ib(factory=list)
+    _restoration = attr.ib(default=None)
+    _model_ready = attr.ib(factory=asyncio.Event)
+    _sentence_slots = attr.ib(default=None)
+    _waiting_sentences = attr.ib(default=0)
+    _sentence_pool = attr.ib(factory=collections.deque)
+    _pool_refill = attr.ib(default=None)
+    _build_retries = attr.ib(default=0)
+    _build_retry = attr.ib(default=None)
+    _closed = attr.ib(default=False)
 
     def __attrs_post_init__(self):
-        self._schedule_new_text()
+        self._sentence_slots = asyncio.Semaphore(self._sentence_concurrency)
+        self._model = self._model_class.build([])
+        self._restoration = self._event_loop.create_task(self._restore_model())
+        self._text_lifespan.reset()
+        self._compaction_lifespan.reset()
+
+    @property
+    def transition_count(self):
+        return self._model.transition_count
+
+    def learn(self, record_id, sentence):
+        self._pending_knowledge.append((record_id, _strip_dot(sentence)))
+
+    def close(self):
+        # Requests in flight are still served, only background work stops
+        self._closed = True
+        self._rebuild_scheduler.cancel(self._key)
+        if self._pool_refill is not None:
+            self._pool_refill.cancel()
+        if self._build_retry is not None:
+            self._build_retry.cancel()
+
+    def compact(self):
+        self._schedule(self._build_model, self._COMPACTION_WEIGHT)
+        self._text_lifespan.reset()
+        self._compaction_lifespan.reset()
 
     async def make_sentence(self):
-        if not self._text_lifespan:
-            self._schedule_new_text()
+        self._last_demand = time.time()
 
-        if self._sentence_is_building:
-            self._log.info("Sentence is building")
+        if not self._restoration.done():
+            await asyncio.wait([self._restoration])
+
+        if not self._compaction_lifespan:
+            self.compact()
+        elif not self._text_lifespan:
+            self._schedule_model_extension()
+        else:
+            self._rebuild_scheduler.promote(self._key, -self._last_demand)
+
+        if not self._model_ready.is_set():
+            # A cold text is still being built, waiting for it would only time the caller out
+            _SENTENCES.labels("not_ready").inc()
+            self._schedule_pool_refill()
+            return None
+
+        if self._sentence_pool:
+            _SENTENCES.labels("pooled").inc()
+            sentence = self._sentence_pool.popleft()
+        else:
+            sentence = await self._make_sentence_now()
+        self._schedule_pool_refill()
+        return sentence
+
+    async def _make_sentence_now(self):
+        # Bursts wait for a free slot, only the overflow beyond the queue depth is turned away
+        if self._waiting_sentences >= self._sentence_queue_depth:
+            self._log.info("Sentence queue is full")
+            _SENTENCES.labels("queue_full").inc()
             return None
 
+        self._waiting_sentences += 1
+        try:
+            await asyncio.wait_for(self._acquire_sentence_slot(), timeout=self._sentence_wait_timeout)
+        except asyncio.TimeoutError:
+            self._log.info("Timed out waiting for sentence")
+            _SENTENCES.labels("timed_out").inc()
+            return None
+        finally:
+            self._waiting_sentences -= 1
+
         sentence = None
-        with self._sentence_building_session():
-            sentence = await self._build_sentence()
+        try:
+            with tracing.span("markov:sentence"):
+                sentence = await self._build_sentence()
+            _SENTENCES.labels("generated" if sentence is not None else "failed").inc()
             if sentence is None:
                 self._log.error("Failed to produce sentence")
+        except Exception as ex:
+            self._log.error("[CachedMarkovText] Failed to build sentence: {}".format(ex))
+        finally:
+            self._sentence_slots.release()
 
         return sentence
 
-    def _schedule_new_text(self):
-        self._event_loop.create_task(self._build_text())
+    async def _acquire_sentence_slot(self):
+        # Nothing useful can be said until the first snapshot is restored or built
+        await self._model_ready.wait()
+        await self._sentence_slots.acquire()
+
+    def _schedule_pool_refill(self, force=False):
+        if self._closed:
+            return
+        if self._pool_refill is not None and not self._pool_refill.done():
+            return
+        if not force and len(self._sentence_pool) > self._sentence_pool_refill_threshold:
+            return
+        self._pool_refill = self._event_loop.create_task(self._refill_sentence_pool())
+
+    async def _refill_sentence_pool(self):
+        await self._model_ready.wait()
+        while len(self._sentence_pool) < self._sentence_pool_size:
+            model = self._model
+            async with self._sentence_slots:
+                try:
+                    sentence = await self._build_sentence()
+                except Exception as ex:
+                    self._log.error("Failed to refill sentence pool: {}".format(ex))
+                    return
+            if sentence is None:
+                return
+            # Sentences of a replaced model are stale
+            if model is self._model:
+                self._sentence_pool.append(sentence)
+
+    def _schedule_model_extension(self):
+        self._schedule(self._extend_model, self._EXTENSION_WEIGHT)
         self._text_lifespan.reset()
 
-    async def _build_text(self):
-        knowledge = ". ".join([sentence async for sentence in _strip_dots(self._knowledge_source())])
-        self._text = await self._event_loop.run_in_executor(self._worker, lambda: markovify.Text(knowledge))
+    def _schedule(self, job, weight):
+        if self._closed:
+            return
+        # Recently asked models are rebuilt first
+        self._rebuild_scheduler.schedule(self._key, job, priority=-self._last_demand, weight=weight)
+
+    async def _restore_model(self):
+        try:
+            self._model, metadata = await self._worker.load(self._model_class, self._snapshot_path)
+        except FileNotFoundError:
+            self._log.info("No snapshot at {}".format(self._snapshot_path))
+            self._schedule(self._build_model, self._COMPACTION_WEIGHT)
+            return
+        except Exception as ex:
+            self._log.error("Failed to load snapshot {}: {}".format(self._snapshot_path, ex))
+            self._schedule(self._build_model, self._COMPACTION_WEIGHT)
+            return
+
+        self._last_record_id = metadata["last_record_id"]
+        self._compaction_lifespan.reset(metadata["compacted_at"])
+        self._log.info("Restored text from {}".format(self._snapshot_path))
+        self._model_changed()
+        self._model_ready.set()
+        self._schedule_pool_refill(force=True)
+
+        self._schedule(self._top_up_model, self._TOP_UP_WEIGHT)
+
+    async def _build_model(self):
+        try:
+            until = await self._knowledge_watermark()
+            with _MODEL_JOB_SECONDS.labels("build").time():
+                model = await self._worker.build(
+                    self._model_class,
+                    _stripped_batches(self._knowledge_source(until=until), self._ingestion_batch_size),
+                )
+        except Exception as ex:
+            self._log.error("Failed to build text for {}: {}".format(self._key, ex))
+            self._schedule_build_retry()
+            return
+
+        self._build_retries = 0
+        self._model = model
+        self._last_record_id = until
         self._log.info("Successfully built new text")
+        self._model_changed()
+        self._model_ready.set()
+        self._sentence_pool.clear()
+        self._schedule_pool_refill(force=True)
+
+        await self._save_model()
+
+    def _schedule_build_retry(self):
+        if self._closed:
+            return
+        # Without a retry a text that failed its first build would never be ready
+        delay = min(self._build_retry_delay * 2**self._build_retries, self._build_retry_max_delay)
+        self._build_retries += 1
+        self._log.info("Retrying build of text for {} in {:.0f} seconds".format(self._key, delay))
+        self._build_retry = self._event_loop.call_later(
+            delay, self._schedule, self._build_model, self._COMPACTION_WEIGHT
+        )
+
+    async def _top_up_model(self):
+        until = await self._knowledge_watermark()
+        knowledge_size = 0
+        with _MODEL_JOB_SECONDS.labels("top_up").time():
+            async for knowledge in _stripped_batches(
+                self._knowledge_source(since=self._last_record_id, until=until), self._ingestion_batch_size
+            ):
+                self._model = await self._worker.extend(self._model, self._snapshot_path, knowledge)
+                knowledge_size += len(knowledge)
+        self._last_record_id = until
+        if not knowledge_size:
+            return
+
+        self._log.info("Topped up text with {} sentences".format(knowledge_size))
+
+        await self._save_model()
+        self._model_changed()
+
+    async def _extend_model(self):
+        # Knowledge waits until a model is restored or built, an empty model must not be saved over history
+        if not self._model_ready.is_set():
+            return
+
+        knowledge, self._pending_knowledge = self._pending_knowledge, []
+        # Knowledge up to the last record id is already a part of the model
+        knowledge = [
+            (record_id, sentence)
+            for record_id, sentence in knowledge
+            if self._last_record_id is None or record_id > self._last_record_id
+        ]
+        if not knowledge:
+            return
+
+        with _MODEL_JOB_SECONDS.labels("extend").time():
+            self._model = await self._worker.extend(
+                self._model, self._snapshot_path, [sentence for _, sentence in knowledge]
+            )
+        self._last_record_id = max(record_id for record_id, _ in knowledge)
+        self._log.info("Extended text with {} new sentences".format(len(knowledge)))
 
-    @contextlib.contextmanager
-    def _sentence_building_session(self):
-        self._sentence_is_building = True
+        await self._save_model()
+        self._model_changed()
+
+    def _model_changed(self):
+        if self._on_model_change is not None:
+            self._on_model_change()
+
+    async def _save_model(self):
+        if not self._model_ready.is_set():
+            return
+
+        metadata = {"last_record_id": self._last_record_id, "compacted_at": self._compaction_lifespan.stamp}
         try:
-            yield
+            with _MODEL_JOB_SECONDS.labels("save").time():
+                # Saving may hand back the model loaded again from its snapshot
+                self._model = await self._worker.save(self._model, self._snapshot_path, metadata)
         except Exception as ex:
-            self._log.error("[CachedMarkovText] Failed to build sentence: {}".format(ex))
-        finally:
-            self._sentence_is_building = False
+            self._log.error("Failed to save snapshot {}: {}".format(self._snapshot_path, ex))
 
     async def _build_sentence(self):
-        text = self._text
-        make_sentence_attempts = self._make_sentence_attempts
-        return await self._event_loop.run_in_executor(
-            self._worker, lambda: text.make_sentence(tries=make_sentence_attempts)
-        )
+        with _SENTENCE_SECONDS.time():
+            return await self._worker.make_sentence(
+                self._model, self._snapshot_path, tries=self._make_sentence_attempts
+            )
 
 
 @logged
 @attr.s(slots=True)
-class MarkovChainIntelligenceCore(IntelligenceCore):
-    class Strategy(enum.Enum):
-        BY_CURRENT_CHAT = enum.auto()
-        BY_CURRENT_USER = enum.auto()
-        BY_FULL_KNOWLEDGE = enum.auto()
-
+class MarkovTextRegistry:
     _knowledge_base = attr.ib(validator=attr.validators.instance_of(KnowledgeBase))
+    _learning_feed = attr.ib()
     _text_constructor = attr.ib()
-    _markov_texts = attr.ib()
+    _knowledge_sources = attr.ib()
+    _snapshot_directory = attr.ib()
+    _knowledge_lifespan = attr.ib()
+    _compaction_lifespan = attr.ib()
+    _refresh_jitter = attr.ib()
+    _texts = attr.ib(validator=attr.validators.instance_of(BoundedCache))
 
     @classmethod
-    def build(cls, event_loop, worker, chat_id, knowledge_base, knowledge_lifespan, make_sentence_attempts):
-        text_constructor = functools.partial(
-            CachedMarkovText,
-            event_loop=event_loop,
-            worker=worker,
-            make_sentence_attempts=make_sentence_attempts,
-            text_lifespan=knowledge_lifespan,
-        )
+    def build(
+        cls,
+        event_loop,
+        worker,
+        rebuild_scheduler,
+        knowledge_base,
+        learning_feed,
+        model_class,
+        snapshot_directory,
+        knowledge_lifespan,
+        compaction_lifespan,
+        refresh_jitter,
+        make_sentence_attempts,
+        ingestion_batch_size,
+        sentence_concurrency,
+        sentence_queue_depth,
+        sentence_wait_timeout,
+        sentence_pool_size,
+        sentence_pool_refill_threshold,
+        build_retry_delay,
+        build_retry_max_delay,
+        text_cache_size,
+        text_cache_idle_ttl,
+        text_cache_max_transitions,
+    ):
+        os.makedirs(snapshot_directory, exist_ok=True)
         return cls(
             knowledge_base=knowledge_base,
-            text_constructor=text_constructor,
-            markov_texts={
-                cls.Strategy.BY_CURRENT_CHAT: text_constructor(
-                    knowledge_source=functools.partial(knowledge_base.select_by_chat, chat_id)
-                ),
-                cls.Strategy.BY_FULL_KNOWLEDGE: text_constructor(
-                    knowledge_source=knowledge_base.select_by_full_knowledge
-                ),
+            learning_feed=learning_feed,
+            text_constructor=functools.partial(
+                CachedMarkovText,
+                event_loop=event_loop,
+                worker=worker,
+                rebuild_scheduler=rebuild_scheduler,
+                knowledge_watermark=knowledge_base.last_record_id,
+                model_class=model_class,
+                make_sentence_attempts=make_sentence_attempts,
+                ingestion_batch_size=ingestion_batch_size,
+                sentence_concurrency=sentence_concurrency,
+                sentence_queue_depth=sentence_queue_depth,
+                sentence_wait_timeout=sentence_wait_timeout,
+                sentence_pool_size=sentence_pool_size,
+                sentence_pool_refill_threshold=sentence_pool_refill_threshold,
+                build_retry_delay=build_retry_delay,
+                build_retry_max_delay=build_retry_max_delay,
+            ),
+            knowledge_sources={
+                CHAT_SCOPE: knowledge_base.select_by_chat,
+                USER_SCOPE: knowledge_base.select_by_user,
+                FULL_KNOWLEDGE_SCOPE: knowledge_base.select_by_full_knowledge,
             },
+            snapshot_directory=snapshot_directory,
+            knowledge_lifespan=knowledge_lifespan,
+            compaction_lifespan=compaction_lifespan,
+            refresh_jitter=refresh_jitter,
+            # Evicted texts are restored from their snapshots when they are asked for again
+            texts=BoundedCache(
+                name="Markov texts",
+                max_size=text_cache_size,
+                idle_ttl=text_cache_idle_ttl,
+                max_weight=text_cache_max_transitions,
+                weigher=lambda text: text.transition_count,
+                on_evict=lambda _, text: text.close(),
+            ),
         )
 
+    def __attrs_post_init__(self):
+        _TRANSITIONS.set_function(lambda: sum(text.transition_count for text in self._texts.values()))
+
+    def get(self, key):
+        text = self._texts.get(key)
+        if text is None:
+            scope, *scope_args = key
+            text = self._text_constructor(
+                key=key,
+                knowledge_source=functools.partial(self._knowledge_sources[scope], *scope_args),
+                snapshot_path=self._snapshot_path(key),
+                text_lifespan=Lifespan(self._knowledge_lifespan, jitter=self._refresh_jitter),
+                compaction_lifespan=Lifespan(self._compaction_lifespan, jitter=self._refresh_jitter),
+                # Texts start empty, they are weighed again whenever their model grows or is replaced
+                on_model_change=functools.partial(self._texts.update_weight, key),
+            )
+            self._learning_feed.subscribe(key, text)
+            self._texts.put(key, text)
+            self._log.info("Created text for {}".format(key))
+        return text
+
+    def _snapshot_path(self, key):
+        name = "-".join(urllib.parse.quote(str(part), safe="") for part in key)
+        return os.path.join(self._snapshot_directory, "{}.snapshot".format(name))
+
+
+@logged
+@attr.s(slots=True)
+class MarkovChainIntelligenceCore(IntelligenceCore):
+    class Strategy(enum.Enum):
+        BY_CURRENT_CHAT = enum.auto()
+        BY_CURRENT_USER = enum.auto()
+        BY_FULL_KNOWLEDGE = enum.auto()
+
+    _chat_id = attr.ib()
+    _text_registry = attr.ib(validator=attr.validators.instance_of(MarkovTextRegistry))
+
     async def conceive(self):
         response = await self._form_message(
             strategies=[self.Strategy.BY_CURRENT_CHAT, self.Strategy.BY_FULL_KNOWLEDGE]
@@ -131,14 +480,12 @@ class MarkovChainIntelligenceCore(IntelligenceCore):
     async def _form_message(self, strategies, user=None):
         strategy = random.choice(strategies)
         if strategy == self.Strategy.BY_CURRENT_USER:
-            text_key = (strategy, user)
-            if text_key not in self._markov_texts:
-                self._markov_texts[text_key] = self._text_constructor(
-                    knowledge_source=functools.partial(self._knowledge_base.select_by_user, user)
-                )
+            text_key = user_key(user)
+        elif strategy == self.Strategy.BY_CURRENT_CHAT:
+            text_key = chat_key(self._chat_id)
         else:
-            text_key = strategy
+            text_key = FULL_KNOWLEDGE_KEY
 
         self._log.info("Using text for {}".format(text_key))
 
-        return await self._markov_texts[text_key].make_sentence()
+        return await self._text_registry.get(text_key).make_sentence()
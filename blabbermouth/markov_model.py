@@ -0,0 +1,119 @@
+import json
+import threading
+
+import attr
+import markovify
+from markovify.chain import BEGIN, END
+
+from util.atomic_file import atomic_write
+
+STATE_SIZE = 2
+
+# Shared markovify sentence splitting and filtering, so every backend learns the same runs
+SENTENCE_PARSER = markovify.Text(".", retain_original=False)
+
+
+def parse_sentences(sentences):
+    # Every sentence is terminated, so a batch parses the same way as a part of a whole corpus
+    return list(SENTENCE_PARSER.generate_corpus("".join("{}. ".format(sentence) for sentence in sentences)))
+
+
+def _count_transitions(model, runs, state_size):
+    new_transitions = 0
+    for run in runs:
+        items = ([BEGIN] * state_size) + run + [END]
+        for i in range(len(run) + 1):
+            state = tuple(items[i : i + state_size])
+            follow = items[i + state_size]
+            followers = model.setdefault(state, {})
+            if follow not in followers:
+                new_transitions += 1
+            followers[follow] = followers.get(follow, 0) + 1
+    return new_transitions
+
+
+class _ChunkedText(markovify.Text):
+    # Learned text is kept in chunks, joining every extension to the rest would copy the whole corpus
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rejoined_chunks = [self.rejoined_text] if self.retain_original else []
+
+    def add_runs(self, runs):
+        if self.retain_original:
+            self.parsed_sentences.extend(runs)
+            self.rejoined_chunks.append(self.sentence_join(self.word_join(run) for run in runs))
+
+    def test_sentence_output(self, words, max_overlap_ratio, max_overlap_total):
+        overlap_max = min(max_overlap_total, round(max_overlap_ratio * len(words)))
+        for i in range(max(len(words) - overlap_max, 1)):
+            gram = self.word_join(words[i : i + overlap_max + 1])
+            if any(gram in chunk for chunk in self.rejoined_chunks):
+                return False
+        return True
+
+
+@attr.s(slots=True)
+class MarkovifyModel:
+    _text = attr.ib()
+    _transition_count = attr.ib(default=0)
+    _lock = attr.ib(factory=threading.Lock)
+
+    @classmethod
+    def build(cls, batches):
+        runs = []
+        model = {}
+        transition_count = 0
+        for sentences in batches:
+            batch_runs = parse_sentences(sentences)
+            transition_count += _count_transitions(model, batch_runs, STATE_SIZE)
+            runs.extend(batch_runs)
+
+        if not model:
+            return cls(text=_ChunkedText("."))
+
+        return cls(
+            text=_ChunkedText(
+                None, parsed_sentences=runs, chain=markovify.Chain(None, STATE_SIZE, model=model)
+            ),
+            transition_count=transition_count,
+        )
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as fd:
+            return cls.loads(fd.read())
+
+    @classmethod
+    def loads(cls, data):
+        snapshot = json.loads(data)
+        text = _ChunkedText.from_dict(snapshot["text"])
+        transition_count = sum(len(followers) for followers in text.chain.model.values())
+        return cls(text=text, transition_count=transition_count), snapshot["metadata"]
+
+    @property
+    def transition_count(self):
+        return self._transition_count
+
+    def dump(self, path, metadata):
+        snapshot = self.dumps(metadata)
+        with atomic_write(path) as fd:
+            fd.write(snapshot)
+
+    def dumps(self, metadata):
+        with self._lock:
+            return json.dumps({"metadata": metadata, "text": self._text.to_dict()})
+
+    def extend(self, sentences):
+        text = self._text
+        runs = parse_sentences(sentences)
+        if not runs:
+            return
+
+        with self._lock:
+            self._transition_count += _count_transitions(text.chain.model, runs, text.state_size)
+            text.chain.precompute_begin_state()
+            text.add_runs(runs)
+
+    def make_sentence(self, tries):
+        with self._lock:
+            return self._text.make_sentence(tries=tries)
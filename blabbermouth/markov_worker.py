@@ -0,0 +1,188 @@
+import asyncio
+import collections
+import functools
+import os
+import queue
+import weakref
+
+import attr
+
+from util.log import logged
+
+_SNAPSHOT_CACHE_SIZE = 32
+# Markovify models are held whole in memory, so the cache is bounded by transitions and not only by count
+_SNAPSHOT_CACHE_MAX_TRANSITIONS = 5000000
+
+# Models loaded by a worker process with their snapshot stamp and transitions, keyed by snapshot path
+_snapshot_cache = collections.OrderedDict()
+
+
+def _build_serialized(model_class, batch_queue):
+    return model_class.build(iter(batch_queue.get, None)).dumps(metadata=None)
+
+
+def _iterate_in_loop(async_iterable, event_loop):
+    iterator = async_iterable.__aiter__()
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(iterator.__anext__(), event_loop).result()
+        except StopAsyncIteration:
+            return
+
+
+def _load_snapshot(model_class, snapshot_path):
+    stamp = os.stat(snapshot_path).st_mtime_ns
+    cached = _snapshot_cache.pop(snapshot_path, None)
+    if cached is None or cached[0] != stamp:
+        model, _ = model_class.load(snapshot_path)
+        cached = (stamp, model, model.transition_count)
+
+    _snapshot_cache[snapshot_path] = cached
+    # The model just used is kept even if it alone outweighs the limit
+    while len(_snapshot_cache) > 1 and (
+        len(_snapshot_cache) > _SNAPSHOT_CACHE_SIZE
+        or sum(transitions for _, _, transitions in _snapshot_cache.values())
+        > _SNAPSHOT_CACHE_MAX_TRANSITIONS
+    ):
+        _snapshot_cache.popitem(last=False)
+
+    return cached[1]
+
+
+def _make_sentence_from_snapshot(model_class, snapshot_path, tries):
+    return _load_snapshot(model_class, snapshot_path).make_sentence(tries=tries)
+
+
+def _extend_snapshot(model_class, snapshot_path, sentences, metadata):
+    model = _load_snapshot(model_class, snapshot_path)
+    model.extend(sentences)
+    model.dump(snapshot_path, metadata)
+    # The next use maps the new snapshot instead of keeping the extended copy in this process
+    _snapshot_cache.pop(snapshot_path, None)
+
+
+@attr.s(slots=True)
+class ThreadMarkovWorker:
+    _event_loop = attr.ib()
+    _executor = attr.ib()
+
+    async def build(self, model_class, batches):
+        return await self._event_loop.run_in_executor(
+            self._executor, model_class.build, _iterate_in_loop(batches, self._event_loop)
+        )
+
+    async def extend(self, model, snapshot_path, sentences):
+        await self._event_loop.run_in_executor(self._executor, model.extend, sentences)
+        return model
+
+    async def make_sentence(self, model, snapshot_path, tries):
+        return await self._event_loop.run_in_executor(
+            self._executor, functools.partial(model.make_sentence, tries=tries)
+        )
+
+    async def load(self, model_class, snapshot_path):
+        return await self._event_loop.run_in_executor(self._executor, model_class.load, snapshot_path)
+
+    async def loads(self, model_class, data):
+        return await self._event_loop.run_in_executor(self._executor, model_class.loads, data)
+
+    async def save(self, model, snapshot_path, metadata):
+        await self._event_loop.run_in_executor(self._executor, model.dump, snapshot_path, metadata)
+        return model
+
+
+@logged
+@attr.s(slots=True)
+class ProcessMarkovWorker:
+    _event_loop = attr.ib()
+    _executor = attr.ib()
+    _thread_worker = attr.ib(validator=attr.validators.instance_of(ThreadMarkovWorker))
+    _manager = attr.ib()
+    _batch_queue_depth = attr.ib(default=2)
+    _put_timeout = attr.ib(default=0.5)
+    # The model each snapshot was last loaded or saved from and the sentences it learned since
+    _snapshots = attr.ib(factory=dict)
+
+    async def build(self, model_class, batches):
+        batch_queue = self._manager.Queue(maxsize=self._batch_queue_depth)
+        serialized_model = self._event_loop.run_in_executor(
+            self._executor, _build_serialized, model_class, batch_queue
+        )
+        try:
+            async for sentences in batches:
+                if not await self._put(batch_queue, sentences, serialized_model):
+                    break
+        finally:
+            await self._put(batch_queue, None, serialized_model)
+
+        # Deserializing a large model takes seconds, which the event loop cannot spare
+        model, _ = await self._thread_worker.loads(model_class, await serialized_model)
+        return model
+
+    async def _put(self, batch_queue, item, serialized_model):
+        # A build that failed in the worker stops consuming, so a put must not outwait it
+        while not serialized_model.done():
+            try:
+                await self._event_loop.run_in_executor(
+                    None, functools.partial(batch_queue.put, item, timeout=self._put_timeout)
+                )
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    async def extend(self, model, snapshot_path, sentences):
+        # Sentences of a model saved to its snapshot are learned by the snapshot on the next save, and the
+        # model is loaded from it again then, so the extension is done only once
+        snapshot_model, unsaved = self._snapshots.get(snapshot_path, (None, None))
+        if snapshot_model is not None and snapshot_model() is model:
+            unsaved.extend(sentences)
+            return model
+
+        return await self._thread_worker.extend(model, snapshot_path, sentences)
+
+    async def make_sentence(self, model, snapshot_path, tries):
+        # Worker processes generate from the saved snapshot, which is missing until the first build
+        if not os.path.exists(snapshot_path):
+            return await self._thread_worker.make_sentence(model, snapshot_path, tries)
+
+        return await self._event_loop.run_in_executor(
+            self._executor, _make_sentence_from_snapshot, type(model), snapshot_path, tries
+        )
+
+    async def load(self, model_class, snapshot_path):
+        model, metadata = await self._thread_worker.load(model_class, snapshot_path)
+        self._snapshots[snapshot_path] = (weakref.ref(model), [])
+        return model, metadata
+
+    async def save(self, model, snapshot_path, metadata):
+        # A snapshot of the same model only needs the new sentences, extending it in a worker process keeps
+        # the compaction and the rewrite of the whole model off the event loop process
+        snapshot_model, unsaved = self._snapshots.pop(snapshot_path, (None, None))
+        if snapshot_model is not None and snapshot_model() is model:
+            try:
+                await self._event_loop.run_in_executor(
+                    self._executor, _extend_snapshot, type(model), snapshot_path, unsaved, metadata
+                )
+            except Exception as ex:
+                self._log.warning(
+                    "Failed to extend snapshot {}, saving it whole: {}".format(snapshot_path, ex)
+                )
+            else:
+                return await self._reload(model, snapshot_path, unsaved)
+
+            # Sentences the snapshot failed to learn are still owed to the model
+            await self._thread_worker.extend(model, snapshot_path, unsaved)
+
+        await self._thread_worker.save(model, snapshot_path, metadata)
+        self._snapshots[snapshot_path] = (weakref.ref(model), [])
+        return model
+
+    async def _reload(self, model, snapshot_path, unsaved):
+        try:
+            model, _ = await self._thread_worker.load(type(model), snapshot_path)
+        except Exception as ex:
+            self._log.warning("Failed to reload snapshot {}, extending it here: {}".format(snapshot_path, ex))
+            await self._thread_worker.extend(model, snapshot_path, unsaved)
+        self._snapshots[snapshot_path] = (weakref.ref(model), [])
+        return model
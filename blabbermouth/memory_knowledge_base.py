@@ -0,0 +1,41 @@
+import itertools
+
+import attr
+
+from knowledge_base import KnowledgeBase
+
+
+@attr.s(slots=True)
+class MemoryKnowledgeBase(KnowledgeBase):
+    # Record ids are positions in the list plus one, so id ranges map to slices
+    _records = attr.ib(factory=list)
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def record(self, chat_id, user, text):
+        self._records.append((chat_id, user, text))
+        return len(self._records)
+
+    async def last_record_id(self):
+        return len(self._records) or None
+
+    async def select_by_chat(self, chat_id, since=None, until=None):
+        for record_chat_id, _, text in self._select(since, until):
+            if record_chat_id == chat_id:
+                yield text
+
+    async def select_by_user(self, user, since=None, until=None):
+        for _, record_user, text in self._select(since, until):
+            if record_user == user:
+                yield text
+
+    async def select_by_full_knowledge(self, since=None, until=None):
+        for _, _, text in self._select(since, until):
+            yield text
+
+    def _select(self, since, until):
+        return itertools.islice(self._records, since or 0, until)
@@ -0,0 +1,33 @@
+import aiohttp.web
+import attr
+
+from util.log import logged
+from util.metrics import MetricsRegistry
+
+
+@logged
+@attr.s(slots=True)
+class MetricsServer:
+    _registry = attr.ib(validator=attr.validators.instance_of(MetricsRegistry))
+    _host = attr.ib()
+    _port = attr.ib()
+    _path = attr.ib()
+    _runner = attr.ib(default=None)
+
+    async def start(self):
+        application = aiohttp.web.Application()
+        application.router.add_get(self._path, self._on_scrape)
+        self._runner = aiohttp.web.AppRunner(application)
+        await self._runner.setup()
+        await aiohttp.web.TCPSite(self._runner, self._host, self._port).start()
+        self._log.info("Serving metrics on {}:{}{}".format(self._host, self._port, self._path))
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _on_scrape(self, request):
+        return aiohttp.web.Response(
+            body=self._registry.render().encode("utf-8"),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
@@ -1,31 +1,182 @@
+import asyncio
+import itertools
+
 import attr
+import bson
 import motor.motor_asyncio
+import pymongo
+import pymongo.errors
 
 from knowledge_base import KnowledgeBase
+from util import metrics
+from util.log import logged
+
+_MONGO_SECONDS = metrics.histogram("blabbermouth_mongo_seconds", "Mongo operation latency", ["operation"])
+_PENDING_RECORDS = metrics.gauge("blabbermouth_mongo_pending_records", "Records waiting to be written")
+_DROPPED_RECORDS = metrics.counter(
+    "blabbermouth_mongo_dropped_records_total", "Records that could not be written"
+)
+
+_DUPLICATE_KEY = 11000
+
 
+def _record_id_range(since, until):
+    bounds = {}
+    if since is not None:
+        bounds["$gt"] = bson.ObjectId(since)
+    if until is not None:
+        bounds["$lte"] = bson.ObjectId(until)
+    return {"_id": bounds} if bounds else {}
 
+
+@logged
 @attr.s(slots=True)
 class MongoKnowledgeBase(KnowledgeBase):
     _client = attr.ib()
     _collection = attr.ib()
+    _write_batch_size = attr.ib()
+    _write_flush_interval = attr.ib()
+    _read_batch_size = attr.ib()
+    _pending_records = attr.ib()
+    _write_retries = attr.ib()
+    _write_retry_delay = attr.ib()
+    _writer = attr.ib(default=None)
 
     @classmethod
-    def build(cls, host, port, db_name, db_collection):
+    def build(
+        cls,
+        host,
+        port,
+        db_name,
+        db_collection,
+        write_batch_size,
+        write_flush_interval,
+        write_queue_depth,
+        write_retries,
+        write_retry_delay,
+        read_batch_size,
+    ):
         client = motor.motor_asyncio.AsyncIOMotorClient(host, port)
-        return cls(client=client, collection=client[db_name][db_collection])
+        return cls(
+            client=client,
+            collection=client[db_name][db_collection],
+            write_batch_size=write_batch_size,
+            write_flush_interval=write_flush_interval,
+            read_batch_size=read_batch_size,
+            pending_records=asyncio.Queue(maxsize=write_queue_depth),
+            write_retries=write_retries,
+            write_retry_delay=write_retry_delay,
+        )
+
+    def __attrs_post_init__(self):
+        self._writer = asyncio.ensure_future(self._write_records())
+        _PENDING_RECORDS.set_function(self._pending_records.qsize)
 
     async def record(self, chat_id, user, text):
-        doc = {"chat_id": chat_id, "user": user, "text": text}
-        await self._collection.insert_one(doc)
+        # Ids are assigned here, so records can be published before they are written
+        doc = {"_id": bson.ObjectId(), "chat_id": chat_id, "user": user, "text": text}
+        await self._pending_records.put(doc)
+        return str(doc["_id"])
 
-    async def select_by_chat(self, chat_id):
-        async for doc in self._collection.find({"chat_id": chat_id}):
-            yield doc["text"]
+    async def open(self):
+        # Record ids follow insertion order, so they double as the resume point of every scope
+        await self._collection.create_index([("chat_id", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)])
+        await self._collection.create_index([("user", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)])
 
-    async def select_by_user(self, user):
-        async for doc in self._collection.find({"user": user}):
-            yield doc["text"]
+    async def close(self):
+        await self._pending_records.put(None)
+        await self._writer
+        self._client.close()
 
-    async def select_by_full_knowledge(self):
-        async for doc in self._collection.find({}):
+    async def last_record_id(self):
+        with _MONGO_SECONDS.labels("last_record_id").time():
+            doc = await self._collection.find_one({}, projection={"_id": True}, sort=[("_id", -1)])
+        return str(doc["_id"]) if doc is not None else None
+
+    async def select_by_chat(self, chat_id, since=None, until=None):
+        async for text in self._select({"chat_id": chat_id, **_record_id_range(since, until)}):
+            yield text
+
+    async def select_by_user(self, user, since=None, until=None):
+        async for text in self._select({"user": user, **_record_id_range(since, until)}):
+            yield text
+
+    async def select_by_full_knowledge(self, since=None, until=None):
+        async for text in self._select(_record_id_range(since, until)):
+            yield text
+
+    async def _select(self, query):
+        cursor = self._collection.find(
+            query,
+            projection={"_id": False, "text": True},
+            sort=[("_id", pymongo.ASCENDING)],
+            batch_size=self._read_batch_size,
+        )
+        async for doc in cursor:
             yield doc["text"]
+
+    async def _write_records(self):
+        # A batch is written once it is full or its first record has waited for the flush interval
+        event_loop = asyncio.get_event_loop()
+        closed = False
+        while not closed:
+            docs = []
+            deadline = None
+            while len(docs) < self._write_batch_size:
+                timeout = None if deadline is None else deadline - event_loop.time()
+                if timeout is not None and timeout <= 0:
+                    break
+                try:
+                    doc = await asyncio.wait_for(self._pending_records.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+                if doc is None:
+                    closed = True
+                    break
+                docs.append(doc)
+                if deadline is None:
+                    deadline = event_loop.time() + self._write_flush_interval
+            await self._insert(docs)
+
+    async def _insert(self, docs):
+        # The writer outlives any batch, records are published already and close waits for it
+        if not docs:
+            return
+        try:
+            await self._insert_with_retries(docs)
+        except pymongo.errors.ConnectionFailure as ex:
+            self._drop(docs, ex)
+        except Exception as ex:
+            # A single record that cannot be stored must not cost the rest of its batch
+            self._log.warning("Writing {} records one by one after {!r}".format(len(docs), ex))
+            for doc in docs:
+                try:
+                    await self._insert_with_retries([doc])
+                except Exception as ex:
+                    self._drop([doc], ex)
+
+    async def _insert_with_retries(self, docs):
+        for attempt in itertools.count():
+            try:
+                with _MONGO_SECONDS.labels("insert_many").time():
+                    await self._collection.insert_many(docs, ordered=False)
+                return
+            except pymongo.errors.BulkWriteError as ex:
+                # Records of an interrupted attempt may have been stored before it failed
+                if ex.details.get("writeConcernErrors") or any(
+                    error["code"] != _DUPLICATE_KEY for error in ex.details["writeErrors"]
+                ):
+                    raise
+                return
+            except pymongo.errors.ConnectionFailure as ex:
+                if attempt >= self._write_retries:
+                    raise
+                delay = self._write_retry_delay * 2**attempt
+                self._log.warning(
+                    "Retrying write of {} records in {}s after {!r}".format(len(docs), delay, ex)
+                )
+                await asyncio.sleep(delay)
+
+    def _drop(self, docs, ex):
+        _DROPPED_RECORDS.inc(len(docs))
+        self._log.error("Failed to write {} records: {!r}".format(len(docs), ex))
@@ -0,0 +1,270 @@
+import asyncio
+import collections
+import enum
+import functools
+import itertools
+import time
+
+import attr
+import telepot.exception
+
+from util import metrics
+from util.log import logged
+
+_QUEUED = metrics.gauge("blabbermouth_outbound_queued", "Messages waiting to be sent")
+_IN_FLIGHT = metrics.gauge("blabbermouth_outbound_in_flight", "Chats with a message being sent")
+_SENT = metrics.counter("blabbermouth_outbound_messages_total", "Outbound messages by outcome", ["outcome"])
+_SEND_SECONDS = metrics.histogram("blabbermouth_outbound_send_seconds", "Telegram send latency", ["method"])
+
+
+class Urgency(enum.IntEnum):
+    REPLY = 0
+    CHATTER = 1
+
+
+@attr.s(slots=True)
+class _TokenBucket:
+    _rate = attr.ib()
+    _burst = attr.ib()
+    _tokens = attr.ib(default=None)
+    _updated_at = attr.ib(factory=time.monotonic)
+
+    def __attrs_post_init__(self):
+        self._tokens = self._burst
+
+    @property
+    def is_full(self):
+        self._refill(time.monotonic())
+        return self._tokens >= self._burst
+
+    def delay(self, now):
+        self._refill(now)
+        return max(0.0, (1 - self._tokens) / self._rate)
+
+    def take(self):
+        self._tokens -= 1
+
+    def _refill(self, now):
+        self._tokens = min(self._burst, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+
+@attr.s(slots=True)
+class _Outgoing:
+    chat_id = attr.ib()
+    urgency = attr.ib()
+    method = attr.ib()
+    args = attr.ib()
+    kwargs = attr.ib()
+    future = attr.ib()
+    enqueued_at = attr.ib(factory=time.monotonic)
+    attempts = attr.ib(default=0)
+
+
+@attr.s(slots=True)
+class BotTransport:
+    _bot_accessor = attr.ib()
+
+    async def __call__(self, method, chat_id, *args, **kwargs):
+        return await getattr(self._bot_accessor(), method)(chat_id, *args, **kwargs)
+
+
+@attr.s(slots=True)
+class ChatSender:
+    _dispatcher = attr.ib()
+    _chat_id = attr.ib()
+
+    def sendMessage(self, *args, urgency=Urgency.REPLY, **kwargs):
+        return self._dispatcher.send(self._chat_id, urgency, "sendMessage", *args, **kwargs)
+
+    def sendVoice(self, *args, urgency=Urgency.REPLY, **kwargs):
+        return self._dispatcher.send(self._chat_id, urgency, "sendVoice", *args, **kwargs)
+
+
+@logged
+@attr.s(slots=True)
+class OutboundDispatcher:
+    _MAX_CHAT_BUCKETS = 1024
+
+    _event_loop = attr.ib()
+    _transport = attr.ib()
+    _global_bucket = attr.ib(validator=attr.validators.instance_of(_TokenBucket))
+    _chat_rate = attr.ib()
+    _chat_burst = attr.ib()
+    _chatter_stale_after = attr.ib()
+    _max_retries = attr.ib()
+    _max_in_flight = attr.ib()
+    _queues = attr.ib(factory=lambda: {urgency: collections.deque() for urgency in Urgency})
+    _chat_buckets = attr.ib(factory=dict)
+    _blocked_until = attr.ib(factory=dict)
+    _in_flight = attr.ib(factory=set)
+    _wakeup = attr.ib(factory=asyncio.Event)
+    _worker = attr.ib(default=None)
+
+    delivered = attr.ib(default=0)
+    failed = attr.ib(default=0)
+    retried = attr.ib(default=0)
+    dropped = attr.ib(default=0)
+
+    @classmethod
+    def build(
+        cls,
+        event_loop,
+        transport,
+        global_rate,
+        chat_rate,
+        chat_burst,
+        chatter_stale_after,
+        max_retries,
+        max_in_flight,
+    ):
+        return cls(
+            event_loop=event_loop,
+            transport=transport,
+            global_bucket=_TokenBucket(rate=global_rate, burst=global_rate),
+            chat_rate=chat_rate,
+            chat_burst=chat_burst,
+            chatter_stale_after=chatter_stale_after.total_seconds(),
+            max_retries=max_retries,
+            max_in_flight=max_in_flight,
+        )
+
+    def __attrs_post_init__(self):
+        self._worker = self._event_loop.create_task(self._work())
+        _QUEUED.set_function(lambda: self.queued)
+        _IN_FLIGHT.set_function(self._in_flight.__len__)
+        for outcome in ("delivered", "failed", "retried", "dropped"):
+            _SENT.labels(outcome).set_function(functools.partial(getattr, self, outcome))
+
+    @property
+    def queued(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def sender(self, chat_id):
+        return ChatSender(dispatcher=self, chat_id=chat_id)
+
+    def send(self, chat_id, urgency, method, *args, **kwargs):
+        future = self._event_loop.create_future()
+        if urgency == Urgency.CHATTER:
+            # Only the latest conceived thought of a chat is worth sending
+            for outgoing in [outgoing for outgoing in self._queues[urgency] if outgoing.chat_id == chat_id]:
+                self._queues[urgency].remove(outgoing)
+                self._drop(outgoing)
+
+        self._queues[urgency].append(
+            _Outgoing(
+                chat_id=chat_id, urgency=urgency, method=method, args=args, kwargs=kwargs, future=future
+            )
+        )
+        self._wakeup.set()
+        return future
+
+    async def _work(self):
+        while True:
+            outgoing, delay = self._pick(time.monotonic())
+            if outgoing is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # Messages of different chats are delivered concurrently, those of one chat in order
+            self._in_flight.add(outgoing.chat_id)
+            self._event_loop.create_task(self._deliver(outgoing))
+
+    def _pick(self, now):
+        # Returns the next message allowed by the rate limits, or how long to wait for one
+        if len(self._in_flight) >= self._max_in_flight:
+            return None, None
+        delay = self._global_bucket.delay(now)
+        if delay > 0:
+            return None, delay
+
+        earliest = None
+        for urgency in Urgency:
+            queue = self._queues[urgency]
+            for outgoing in list(queue):
+                if urgency == Urgency.CHATTER and now - outgoing.enqueued_at > self._chatter_stale_after:
+                    queue.remove(outgoing)
+                    self._drop(outgoing)
+                    continue
+
+                if outgoing.chat_id in self._in_flight:
+                    continue
+                bucket = self._chat_bucket(outgoing.chat_id)
+                delay = max(bucket.delay(now), self._blocked_until.get(outgoing.chat_id, now) - now)
+                if delay <= 0:
+                    queue.remove(outgoing)
+                    bucket.take()
+                    self._global_bucket.take()
+                    return outgoing, None
+                earliest = delay if earliest is None else min(earliest, delay)
+        return None, earliest
+
+    async def _deliver(self, outgoing):
+        try:
+            await self._try_deliver(outgoing)
+        finally:
+            self._in_flight.discard(outgoing.chat_id)
+            self._wakeup.set()
+
+    async def _try_deliver(self, outgoing):
+        outgoing.attempts += 1
+        self._rewind(outgoing)
+        try:
+            with _SEND_SECONDS.labels(outgoing.method).time():
+                result = await self._transport(
+                    outgoing.method, outgoing.chat_id, *outgoing.args, **outgoing.kwargs
+                )
+        except telepot.exception.TooManyRequestsError as ex:
+            retry_after = ex.json.get("parameters", {}).get("retry_after", 1)
+            self._log.warning("Rate limited in chat {} for {}s".format(outgoing.chat_id, retry_after))
+            self._blocked_until[outgoing.chat_id] = time.monotonic() + retry_after
+            if outgoing.attempts <= self._max_retries:
+                self.retried += 1
+                self._queues[outgoing.urgency].appendleft(outgoing)
+                return
+            self._fail(outgoing, ex)
+        except Exception as ex:
+            self._fail(outgoing, ex)
+        else:
+            self.delivered += 1
+            if not outgoing.future.done():
+                outgoing.future.set_result(result)
+
+    @staticmethod
+    def _rewind(outgoing):
+        # An attempt that failed mid upload has read the file to its end, a retry must send it whole
+        for arg in itertools.chain(outgoing.args, outgoing.kwargs.values()):
+            if hasattr(arg, "seek"):
+                arg.seek(0)
+
+    def _fail(self, outgoing, ex):
+        self.failed += 1
+        self._log.error("Failed to {} in chat {}: {}".format(outgoing.method, outgoing.chat_id, ex))
+        if not outgoing.future.done():
+            outgoing.future.set_exception(ex)
+
+    def _drop(self, outgoing):
+        self.dropped += 1
+        self._log.info("Dropped stale {} for chat {}".format(outgoing.method, outgoing.chat_id))
+        if not outgoing.future.done():
+            outgoing.future.set_result(None)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > self._MAX_CHAT_BUCKETS:
+                self._forget_idle_chats()
+            bucket = self._chat_buckets[chat_id] = _TokenBucket(rate=self._chat_rate, burst=self._chat_burst)
+        return bucket
+
+    def _forget_idle_chats(self):
+        # A full bucket is the same as a new one, so idle chats need no state
+        now = time.monotonic()
+        for chat_id in [chat_id for chat_id, bucket in self._chat_buckets.items() if bucket.is_full]:
+            del self._chat_buckets[chat_id]
+        for chat_id in [chat_id for chat_id, until in self._blocked_until.items() if until <= now]:
+            del self._blocked_until[chat_id]
@@ -0,0 +1,73 @@
+import asyncio
+import itertools
+
+import attr
+
+from util import metrics
+from util.log import logged
+
+_PENDING = metrics.gauge("blabbermouth_rebuilds_pending", "Model rebuilds waiting for a worker")
+_RUNNING = metrics.gauge("blabbermouth_rebuilds_running", "Model rebuilds in progress")
+
+
+@attr.s(slots=True)
+class _Job:
+    priority = attr.ib()
+    weight = attr.ib()
+    factory = attr.ib()
+
+
+@logged
+@attr.s(slots=True)
+class RebuildScheduler:
+    _concurrency = attr.ib()
+    _queue = attr.ib(factory=asyncio.PriorityQueue)
+    _jobs = attr.ib(factory=dict)
+    _running = attr.ib(factory=set)
+    _sequence = attr.ib(factory=itertools.count)
+    _workers = attr.ib(factory=list)
+
+    def __attrs_post_init__(self):
+        self._workers = [asyncio.ensure_future(self._work()) for _ in range(self._concurrency)]
+        _PENDING.set_function(self._jobs.__len__)
+        _RUNNING.set_function(self._running.__len__)
+
+    def schedule(self, key, factory, priority, weight=0):
+        job = self._jobs.get(key)
+        if job is None:
+            self._jobs[key] = _Job(priority=priority, weight=weight, factory=factory)
+        elif weight > job.weight:
+            job.weight = weight
+            job.factory = factory
+        self.promote(key, priority)
+
+    def cancel(self, key):
+        # Queue entries of the key become stale, a running job is left to finish
+        self._jobs.pop(key, None)
+
+    def promote(self, key, priority):
+        job = self._jobs.get(key)
+        if job is None:
+            return
+
+        job.priority = min(job.priority, priority)
+        if key not in self._running:
+            self._queue.put_nowait((job.priority, next(self._sequence), key))
+
+    async def _work(self):
+        while True:
+            priority, _, key = await self._queue.get()
+            job = self._jobs.get(key)
+            # Stale queue entries are skipped, running keys are requeued once they finish
+            if job is None or job.priority != priority or key in self._running:
+                continue
+
+            del self._jobs[key]
+            self._running.add(key)
+            try:
+                await job.factory()
+            except Exception as ex:
+                self._log.exception(ex)
+            finally:
+                self._running.discard(key)
+                self.promote(key, float("inf"))
@@ -1,8 +1,14 @@
+import asyncio
+import datetime
 import enum
 import json
 
 import attr
 
+from util.bounded_cache import BoundedCache
+from util.lifespan import Lifespan
+from util.log import logged
+
 
 class FeedSortType(enum.Enum):
     HOT = "hot"
@@ -11,27 +17,110 @@ class FeedSortType(enum.Enum):
     TOP = "top"
 
 
+@attr.s(slots=True)
+class _Feed:
+    posts = attr.ib()
+    lifespan = attr.ib(validator=attr.validators.instance_of(Lifespan))
+    etag = attr.ib(default=None)
+    last_modified = attr.ib(default=None)
+
+
+def _parse_permalinks(response_text):
+    # Only permalinks are kept, the rest of the listing is dropped right after parsing
+    return [post["data"]["permalink"] for post in json.loads(response_text)["data"]["children"]]
+
+
+@logged
 @attr.s(slots=True)
 class RedditBrowser:
+    _event_loop = attr.ib()
     _http_session = attr.ib()
     _reddit_url = attr.ib()
     _request_headers = attr.ib()
+    _prefetch_limit = attr.ib()
+    _feed_lifespan = attr.ib(validator=attr.validators.instance_of(datetime.timedelta))
+    _feed_jitter = attr.ib()
+    _feeds = attr.ib(validator=attr.validators.instance_of(BoundedCache))
+    _refreshes = attr.ib(factory=dict)
 
     @classmethod
-    def build(cls, http_session, reddit_url, user_agent):
+    def build(
+        cls,
+        event_loop,
+        http_session,
+        reddit_url,
+        user_agent,
+        prefetch_limit,
+        feed_lifespan,
+        feed_jitter,
+        feed_cache_size,
+    ):
         return cls(
-            http_session=http_session, reddit_url=reddit_url, request_headers={"User-Agent": user_agent}
+            event_loop=event_loop,
+            http_session=http_session,
+            reddit_url=reddit_url,
+            request_headers={"User-Agent": user_agent},
+            prefetch_limit=prefetch_limit,
+            feed_lifespan=feed_lifespan,
+            feed_jitter=feed_jitter,
+            feeds=BoundedCache(name="reddit feeds", max_size=feed_cache_size, idle_ttl=feed_lifespan * 4),
         )
 
-    async def lookup_top_posts(self, subreddit, sort_type, limit):
-        url = "{}/r/{}/{}.json?limit={}".format(self._reddit_url, subreddit, sort_type.value, limit)
+    async def lookup_top_posts(self, subreddit, sort_type, limit=None):
+        key = (subreddit, sort_type)
+        feed = self._feeds.get(key)
+        if feed is None:
+            feed = await asyncio.shield(self._refresh(key))
+        elif not feed.lifespan:
+            # A stale feed is served while a fresh one is fetched in the background
+            self._refresh(key)
+
+        for permalink in feed.posts[:limit]:
+            yield self._reddit_url + permalink
+
+    def _refresh(self, key):
+        # Chats asking for the same feed share a single request
+        refresh = self._refreshes.get(key)
+        if refresh is None:
+            refresh = self._refreshes[key] = self._event_loop.create_task(self._fetch(key))
+            refresh.add_done_callback(lambda done: self._on_refreshed(key, done))
+        return refresh
+
+    def _on_refreshed(self, key, refresh):
+        del self._refreshes[key]
+        if not refresh.cancelled() and refresh.exception() is not None:
+            self._log.warning(
+                "Failed to refresh {} feed of r/{}: {}".format(key[1].value, key[0], refresh.exception())
+            )
+
+    async def _fetch(self, key):
+        subreddit, sort_type = key
+        url = "{}/r/{}/{}.json?limit={}".format(
+            self._reddit_url, subreddit, sort_type.value, self._prefetch_limit
+        )
+        feed = self._feeds.get(key)
+
+        headers = dict(self._request_headers)
+        if feed is not None and feed.etag is not None:
+            headers["If-None-Match"] = feed.etag
+        if feed is not None and feed.last_modified is not None:
+            headers["If-Modified-Since"] = feed.last_modified
+
+        async with self._http_session.get(url, headers=headers) as response:
+            if response.status == 304 and feed is not None:
+                feed.lifespan.reset()
+                return feed
 
-        async with self._http_session.get(url, headers=self._request_headers) as response:
             response_text = await response.text()
             if response.status != 200:
                 raise Exception("Got unwanted response {}: {}".format(response.status, response_text))
 
-        response = json.loads(response_text)
+            feed = _Feed(
+                posts=await self._event_loop.run_in_executor(None, _parse_permalinks, response_text),
+                lifespan=Lifespan(timeout=self._feed_lifespan, jitter=self._feed_jitter),
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+            )
 
-        for post in reversed(response["data"]["children"]):
-            yield self._reddit_url + post["data"]["permalink"]
+        self._feeds.put(key, feed)
+        return feed
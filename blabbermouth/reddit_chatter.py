@@ -1,3 +1,4 @@
+import collections
 import random
 
 import attr
@@ -14,20 +15,28 @@ class RedditChatter(IntelligenceCore):
     _top_post_comments = attr.ib()
     _subreddits_of_interest = attr.ib()
     _sort_types = attr.ib()
+    _remembered_posts = attr.ib()
+    _sent_posts = attr.ib(default=None)
+
+    def __attrs_post_init__(self):
+        self._sent_posts = collections.deque(maxlen=self._remembered_posts)
 
     async def conceive(self):
         subreddit = random.choice(self._subreddits_of_interest)
         sort_type = random.choice(self._sort_types)
 
+        # The topmost post the chat has not seen yet
         top_post = None
-        async for post in self._reddit_browser.lookup_top_posts(subreddit, sort_type, limit=1):
-            top_post = post
-            break
+        async for post in self._reddit_browser.lookup_top_posts(subreddit, sort_type):
+            if post not in self._sent_posts:
+                top_post = post
+                break
         else:
             self._log.warning("Top post was not found")
             return
 
         self._log.info("Top post of choice is {}".format(top_post))
+        self._sent_posts.append(top_post)
 
         return thought.text(self._format_top_post_message(top_post))
 
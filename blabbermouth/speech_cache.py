@@ -0,0 +1,166 @@
+import asyncio
+import contextlib
+import hashlib
+import os
+
+import aiohttp
+import attr
+
+from util.atomic_file import atomic_write
+from util.bounded_cache import BoundedCache
+from util import metrics, tracing
+from util.log import logged
+
+_LOOKUPS = metrics.counter(
+    "blabbermouth_speech_lookups_total", "Speech served past the memory tier", ["source"]
+)
+_SYNTHESIS_SECONDS = metrics.histogram("blabbermouth_speech_synthesis_seconds", "Speech synthesis latency")
+
+
+@logged
+@attr.s(slots=True)
+class CachingSpeechClient:
+    _event_loop = attr.ib()
+    _speech_client = attr.ib()
+    _memory_cache = attr.ib(validator=attr.validators.instance_of(BoundedCache))
+    _directory = attr.ib()
+    _max_disk_entries = attr.ib()
+    _timeout = attr.ib()
+    _retries = attr.ib()
+    _slots = attr.ib()
+    _in_flight = attr.ib(factory=dict)
+    _disk_entries = attr.ib(default=None)
+
+    synthesized = attr.ib(default=0)
+    disk_hits = attr.ib(default=0)
+    deduplicated = attr.ib(default=0)
+
+    @classmethod
+    def build(
+        cls,
+        event_loop,
+        speech_client,
+        directory,
+        memory_size,
+        memory_bytes,
+        memory_idle_ttl,
+        max_disk_entries,
+        timeout,
+        concurrency,
+        retries,
+    ):
+        os.makedirs(directory, exist_ok=True)
+        client = cls(
+            event_loop=event_loop,
+            speech_client=speech_client,
+            memory_cache=BoundedCache(
+                name="speech cache",
+                max_size=memory_size,
+                idle_ttl=memory_idle_ttl,
+                max_weight=memory_bytes,
+                weigher=len,
+            ),
+            directory=directory,
+            max_disk_entries=max_disk_entries,
+            timeout=timeout,
+            retries=retries,
+            slots=asyncio.Semaphore(concurrency),
+        )
+        _LOOKUPS.labels("synthesized").set_function(lambda: client.synthesized)
+        _LOOKUPS.labels("disk").set_function(lambda: client.disk_hits)
+        _LOOKUPS.labels("deduplicated").set_function(lambda: client.deduplicated)
+        return client
+
+    async def vocalize(self, text, voice, lang, audio_format, emotion):
+        key = (text, voice, lang, audio_format, emotion.value)
+        speech = self._memory_cache.get(key)
+        if speech is not None:
+            return speech
+
+        # Identical requests share one lookup, so a popular phrase is synthesized once
+        task = self._in_flight.get(key)
+        if task is None:
+            task = self._in_flight[key] = self._event_loop.create_task(
+                self._load(key, text=text, voice=voice, lang=lang, audio_format=audio_format, emotion=emotion)
+            )
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.deduplicated += 1
+        # A cancelled caller must not cancel the lookup the others are waiting for
+        with tracing.span("speech"):
+            return await asyncio.shield(task)
+
+    async def _load(self, key, **request):
+        path = self._path(key)
+        speech = await self._event_loop.run_in_executor(None, self._read, path)
+        if speech is not None:
+            self.disk_hits += 1
+        else:
+            speech = await self._synthesize(request)
+            try:
+                await self._event_loop.run_in_executor(None, self._write, path, speech)
+            except OSError as ex:
+                self._log.warning("Failed to store speech in {}: {}".format(path, ex))
+
+        self._memory_cache.put(key, speech)
+        return speech
+
+    async def _synthesize(self, request):
+        for attempt in range(self._retries + 1):
+            async with self._slots:
+                try:
+                    with _SYNTHESIS_SECONDS.time():
+                        speech = await asyncio.wait_for(
+                            self._speech_client.vocalize(**request), self._timeout
+                        )
+                except (asyncio.TimeoutError, aiohttp.ClientError) as ex:
+                    if attempt == self._retries:
+                        raise
+                    self._log.warning("Retrying speech synthesis after {!r}".format(ex))
+                    continue
+
+            self.synthesized += 1
+            return speech
+
+    def _path(self, key):
+        digest = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self._directory, "{}.{}".format(digest, key[3]))
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, "rb") as fd:
+                speech = fd.read()
+            # Modification time tracks the last use, so pruning drops the least recently used files
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return speech
+
+    def _write(self, path, speech):
+        with atomic_write(path, "wb") as fd:
+            fd.write(speech)
+
+        if self._disk_entries is None:
+            self._disk_entries = len(os.listdir(self._directory))
+        else:
+            self._disk_entries += 1
+        if self._disk_entries > self._max_disk_entries:
+            self._prune()
+
+    def _prune(self):
+        # Pruning down to nine tenths of the limit keeps it from running on every write
+        paths = [
+            path
+            for _, path in sorted(
+                (entry.stat().st_mtime, entry.path)
+                for entry in os.scandir(self._directory)
+                if entry.is_file()
+            )
+        ]
+        excess = len(paths) - self._max_disk_entries * 9 // 10
+        for path in paths[:excess]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        self._disk_entries = len(paths) - max(excess, 0)
+        self._log.info("Pruned {} cached speech files".format(max(excess, 0)))
@@ -0,0 +1,103 @@
+import concurrent.futures
+import sqlite3
+
+import attr
+
+from knowledge_base import KnowledgeBase
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS records ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, user TEXT NOT NULL, text TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS records_by_chat ON records (chat_id, id)",
+    "CREATE INDEX IF NOT EXISTS records_by_user ON records (user, id)",
+)
+
+
+def _record_id_range(since, until):
+    clauses = []
+    params = []
+    if since is not None:
+        clauses.append("id > ?")
+        params.append(since)
+    if until is not None:
+        clauses.append("id <= ?")
+        params.append(until)
+    return clauses, params
+
+
+@attr.s(slots=True)
+class SqliteKnowledgeBase(KnowledgeBase):
+    _event_loop = attr.ib()
+    _path = attr.ib()
+    _read_batch_size = attr.ib()
+    # sqlite3 connections are bound to a thread, so every call goes through the same one
+    _executor = attr.ib(factory=lambda: concurrent.futures.ThreadPoolExecutor(max_workers=1))
+    _connection = attr.ib(default=None)
+
+    @classmethod
+    def build(cls, event_loop, path, read_batch_size):
+        return cls(event_loop=event_loop, path=path, read_batch_size=read_batch_size)
+
+    async def open(self):
+        await self._run(self._connect)
+
+    async def close(self):
+        await self._run(self._connection.close)
+        self._executor.shutdown()
+
+    async def record(self, chat_id, user, text):
+        return await self._run(self._insert, chat_id, user, text)
+
+    async def last_record_id(self):
+        row = await self._run(self._fetch_one, "SELECT MAX(id) FROM records", ())
+        return row[0]
+
+    async def select_by_chat(self, chat_id, since=None, until=None):
+        async for text in self._select(["chat_id = ?"], [chat_id], since, until):
+            yield text
+
+    async def select_by_user(self, user, since=None, until=None):
+        async for text in self._select(["user = ?"], [user], since, until):
+            yield text
+
+    async def select_by_full_knowledge(self, since=None, until=None):
+        async for text in self._select([], [], since, until):
+            yield text
+
+    async def _run(self, function, *args):
+        return await self._event_loop.run_in_executor(self._executor, function, *args)
+
+    def _connect(self):
+        self._connection = sqlite3.connect(self._path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        for statement in _SCHEMA:
+            self._connection.execute(statement)
+        self._connection.commit()
+
+    def _insert(self, chat_id, user, text):
+        with self._connection:
+            cursor = self._connection.execute(
+                "INSERT INTO records (chat_id, user, text) VALUES (?, ?, ?)", (chat_id, user, text)
+            )
+        return cursor.lastrowid
+
+    def _fetch_one(self, query, params):
+        return self._connection.execute(query, params).fetchone()
+
+    async def _select(self, clauses, params, since, until):
+        range_clauses, range_params = _record_id_range(since, until)
+        clauses = clauses + range_clauses
+        query = "SELECT text FROM records {} ORDER BY id".format(
+            "WHERE {}".format(" AND ".join(clauses)) if clauses else ""
+        )
+        cursor = await self._run(self._connection.execute, query, params + range_params)
+        try:
+            while True:
+                rows = await self._run(cursor.fetchmany, self._read_batch_size)
+                if not rows:
+                    return
+                for (text,) in rows:
+                    yield text
+        finally:
+            await self._run(cursor.close)
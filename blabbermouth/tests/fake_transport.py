@@ -0,0 +1,28 @@
+import asyncio
+
+import attr
+import telepot.exception
+
+
+@attr.s(slots=True)
+class FakeTransport:
+    calls = attr.ib(factory=list)
+    rate_limited = attr.ib(factory=list)
+    delay = attr.ib(default=0.0)
+
+    def limit_next(self, retry_after):
+        self.rate_limited.append(retry_after)
+
+    async def __call__(self, method, chat_id, *args, **kwargs):
+        await asyncio.sleep(self.delay)
+        # Uploads are read before Telegram answers, whether or not the request is accepted
+        args = tuple(arg.read() if hasattr(arg, "read") else arg for arg in args)
+        if self.rate_limited:
+            retry_after = self.rate_limited.pop(0)
+            raise telepot.exception.TooManyRequestsError(
+                "Too Many Requests: retry after {}".format(retry_after),
+                429,
+                {"parameters": {"retry_after": retry_after}},
+            )
+        self.calls.append((method, chat_id, args, kwargs))
+        return {"message_id": len(self.calls)}
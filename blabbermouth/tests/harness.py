@@ -0,0 +1,31 @@
+import asyncio
+import datetime
+
+from outbound_dispatcher import OutboundDispatcher
+
+
+def build_dispatcher(event_loop, transport, chat_rate=100, chat_burst=100):
+    return OutboundDispatcher.build(
+        event_loop=event_loop,
+        transport=transport,
+        global_rate=100,
+        chat_rate=chat_rate,
+        chat_burst=chat_burst,
+        chatter_stale_after=datetime.timedelta(seconds=60),
+        max_retries=3,
+        max_in_flight=8,
+    )
+
+
+def run(coroutine_function):
+    event_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(event_loop)
+    try:
+        return event_loop.run_until_complete(coroutine_function(event_loop))
+    finally:
+        # Background workers run for the lifetime of the loop
+        pending = asyncio.all_tasks(event_loop)
+        for task in pending:
+            task.cancel()
+        event_loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        event_loop.close()
@@ -0,0 +1,124 @@
+import asyncio
+import concurrent.futures
+import datetime
+import os
+
+import attr
+
+from compact_markov_model import CompactMarkovModel
+from harness import run
+from learning_feed import LearningFeed, chat_key
+from markov_chain_intelligence_core import MarkovTextRegistry
+from markov_worker import ThreadMarkovWorker
+from memory_knowledge_base import MemoryKnowledgeBase
+from rebuild_scheduler import RebuildScheduler
+
+
+def build_registry(
+    event_loop,
+    knowledge_base,
+    snapshot_directory,
+    max_transitions=None,
+    knowledge_lifespan=datetime.timedelta(hours=1),
+):
+    return MarkovTextRegistry.build(
+        event_loop=event_loop,
+        worker=ThreadMarkovWorker(
+            event_loop=event_loop, executor=concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        ),
+        rebuild_scheduler=RebuildScheduler(concurrency=1),
+        knowledge_base=knowledge_base,
+        learning_feed=LearningFeed(),
+        model_class=CompactMarkovModel,
+        snapshot_directory=snapshot_directory,
+        knowledge_lifespan=knowledge_lifespan,
+        compaction_lifespan=datetime.timedelta(hours=24),
+        refresh_jitter=0,
+        make_sentence_attempts=10,
+        ingestion_batch_size=100,
+        sentence_concurrency=1,
+        sentence_queue_depth=10,
+        sentence_wait_timeout=5,
+        sentence_pool_size=0,
+        sentence_pool_refill_threshold=0,
+        build_retry_delay=0.01,
+        build_retry_max_delay=0.01,
+        text_cache_size=10,
+        text_cache_idle_ttl=datetime.timedelta(hours=1),
+        text_cache_max_transitions=max_transitions,
+    )
+
+
+async def built(text):
+    # Texts answer nothing until their model is ready, so a test waits for the build itself
+    while not text.transition_count:
+        await asyncio.sleep(0.01)
+    return text
+
+
+def test_evicts_texts_by_transitions_once_they_are_built(tmp_path):
+    async def scenario(event_loop):
+        knowledge_base = MemoryKnowledgeBase()
+        for chat_id in (1, 2):
+            for index in range(100):
+                await knowledge_base.record(
+                    chat_id, "alice", "word{} follows word{} here".format(index, index)
+                )
+        registry = build_registry(event_loop, knowledge_base, str(tmp_path), max_transitions=500)
+
+        first = await asyncio.wait_for(built(registry.get(chat_key(1))), timeout=5)
+        second = await asyncio.wait_for(built(registry.get(chat_key(2))), timeout=5)
+        # Either text alone fits under the limit, both of them together do not
+        assert 0 < first.transition_count <= 500
+        assert first.transition_count + second.transition_count > 500
+        assert registry.get(chat_key(2)) is second
+        assert registry.get(chat_key(1)) is not first
+
+    run(scenario)
+
+
+@attr.s(slots=True)
+class FlakyKnowledgeBase(MemoryKnowledgeBase):
+    failures = attr.ib(default=0)
+
+    async def select_by_chat(self, chat_id, since=None, until=None):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("Knowledge base is unavailable")
+        async for text in super().select_by_chat(chat_id, since=since, until=until):
+            yield text
+
+
+def test_retries_a_failed_build(tmp_path):
+    async def scenario(event_loop):
+        knowledge_base = FlakyKnowledgeBase(failures=2)
+        for index in range(100):
+            await knowledge_base.record(1, "alice", "word{} follows word{} here".format(index, index))
+        registry = build_registry(event_loop, knowledge_base, str(tmp_path))
+
+        text = await asyncio.wait_for(built(registry.get(chat_key(1))), timeout=5)
+        return text.transition_count
+
+    assert run(scenario) > 0
+
+
+def test_keeps_knowledge_pending_until_a_model_is_built(tmp_path):
+    async def scenario(event_loop):
+        knowledge_base = FlakyKnowledgeBase(failures=1000)
+        registry = build_registry(
+            event_loop,
+            knowledge_base,
+            str(tmp_path),
+            knowledge_lifespan=datetime.timedelta(0),
+        )
+
+        text = registry.get(chat_key(1))
+        text.learn(3001, "a sentence learned while the build fails")
+        # Every request finds the knowledge stale and asks for an extension, and is answered without waiting
+        for _ in range(3):
+            assert await asyncio.wait_for(text.make_sentence(), timeout=1) is None
+            await asyncio.sleep(0.05)
+        return text.transition_count
+
+    assert run(scenario) == 0
+    assert os.listdir(str(tmp_path)) == []
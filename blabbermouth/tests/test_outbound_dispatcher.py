@@ -0,0 +1,61 @@
+import asyncio
+import io
+import time
+
+from fake_transport import FakeTransport
+from harness import build_dispatcher, run
+from outbound_dispatcher import Urgency
+
+
+def test_delivers_replies_before_chatter():
+    async def scenario(event_loop):
+        transport = FakeTransport()
+        sender = build_dispatcher(event_loop, transport, chat_rate=1, chat_burst=1).sender(1)
+        # The first message takes the only token, the rest wait and are ordered by urgency
+        await sender.sendMessage("first")
+        chatter = sender.sendMessage("chatter", urgency=Urgency.CHATTER)
+        reply = sender.sendMessage("reply")
+        await asyncio.gather(chatter, reply)
+        return [args[0] for _, _, args, _ in transport.calls]
+
+    assert run(scenario) == ["first", "reply", "chatter"]
+
+
+def test_keeps_only_latest_chatter():
+    async def scenario(event_loop):
+        transport = FakeTransport()
+        sender = build_dispatcher(event_loop, transport, chat_rate=1, chat_burst=1).sender(1)
+        await sender.sendMessage("first")
+        stale = sender.sendMessage("stale", urgency=Urgency.CHATTER)
+        latest = sender.sendMessage("latest", urgency=Urgency.CHATTER)
+        return await stale, await latest, [args[0] for _, _, args, _ in transport.calls]
+
+    stale, latest, sent = run(scenario)
+    assert stale is None
+    assert latest is not None
+    assert sent == ["first", "latest"]
+
+
+def test_waits_retry_after_and_retries():
+    async def scenario(event_loop):
+        transport = FakeTransport()
+        transport.limit_next(retry_after=0.2)
+        dispatcher = build_dispatcher(event_loop, transport)
+        started = time.monotonic()
+        await dispatcher.sender(1).sendMessage("hello")
+        return time.monotonic() - started, dispatcher.retried, transport.calls
+
+    elapsed, retried, calls = run(scenario)
+    assert elapsed >= 0.2
+    assert retried == 1
+    assert len(calls) == 1
+
+
+def test_retries_upload_from_the_start():
+    async def scenario(event_loop):
+        transport = FakeTransport()
+        transport.limit_next(retry_after=0.1)
+        await build_dispatcher(event_loop, transport).sender(1).sendVoice(io.BytesIO(b"speech"))
+        return transport.calls
+
+    assert run(scenario) == [("sendVoice", 1, (b"speech",), {})]
@@ -0,0 +1,146 @@
+import asyncio
+import functools
+
+import attr
+
+from deaf_detector import DeafDetector, DeafDetectorStage
+from fake_transport import FakeTransport
+from harness import build_dispatcher, run
+from work_scheduler import Priority, WorkScheduler
+
+
+@attr.s(slots=True, frozen=True)
+class _Glance:
+    message = attr.ib()
+
+
+@attr.s(slots=True)
+class _State:
+    chat_id = attr.ib()
+    sender = attr.ib()
+    deaf_detector = attr.ib(factory=DeafDetector)
+
+
+def build_scheduler(event_loop, concurrency=8, reply_reserve=2, chat_concurrency=2):
+    return WorkScheduler(
+        event_loop=event_loop,
+        concurrency=concurrency,
+        reply_reserve=reply_reserve,
+        chat_concurrency=chat_concurrency,
+        queue_depth=100,
+        chat_queue_depth=100,
+    )
+
+
+def glance(text, user):
+    return _Glance(message={"text": text, "from": {"username": user}, "chat": {"id": 1}})
+
+
+def test_deaf_detector_answers_go_through_the_dispatcher():
+    async def scenario(event_loop):
+        transport = FakeTransport()
+        work_scheduler = build_scheduler(event_loop)
+        stage = DeafDetectorStage(work_scheduler=work_scheduler)
+        state = _State(chat_id=1, sender=build_dispatcher(event_loop, transport).sender(1))
+        # More answers than the chat may run at once, none of them may leak a slot
+        for _ in range(5):
+            await stage.on_message(glance("я устал", "alice"), state)
+            await stage.on_message(glance("что", "bob"), state)
+        while work_scheduler.running or work_scheduler.queued:
+            await asyncio.sleep(0.01)
+
+        replied = asyncio.Event()
+
+        async def reply():
+            replied.set()
+
+        work_scheduler.submit(1, Priority.REPLY, reply)
+        await asyncio.wait_for(replied.wait(), timeout=1)
+        return work_scheduler, transport
+
+    work_scheduler, transport = run(scenario)
+    assert work_scheduler.failed == 0
+    assert [args[0] for _, _, args, _ in transport.calls] == ["_Он устал_"] * 5
+
+
+def test_work_that_fails_to_start_releases_its_slot():
+    async def scenario(event_loop):
+        work_scheduler = build_scheduler(event_loop, chat_concurrency=1)
+        future = event_loop.create_future()
+        future.set_result(None)
+        for _ in range(3):
+            work_scheduler.submit(1, Priority.REPLY, functools.partial(lambda: future))
+
+        replied = asyncio.Event()
+
+        async def reply():
+            replied.set()
+
+        work_scheduler.submit(1, Priority.REPLY, reply)
+        await asyncio.wait_for(replied.wait(), timeout=1)
+        return work_scheduler
+
+    work_scheduler = run(scenario)
+    assert work_scheduler.failed == 3
+    assert work_scheduler.completed == 1
+
+
+def test_replies_run_while_learning_is_blocked():
+    async def scenario(event_loop):
+        work_scheduler = build_scheduler(event_loop)
+        blocked = event_loop.create_future()
+        replied = asyncio.Event()
+
+        async def learn():
+            await blocked
+
+        async def reply():
+            replied.set()
+
+        # Learning of many chats takes every slot it may, the rest wait in the queue
+        for chat_id in range(20):
+            work_scheduler.submit(chat_id, Priority.LEARNING, learn)
+        running = work_scheduler.running
+        work_scheduler.submit(100, Priority.REPLY, reply)
+        await asyncio.wait_for(replied.wait(), timeout=1)
+        blocked.set_result(None)
+        while work_scheduler.running or work_scheduler.queued:
+            await asyncio.sleep(0.01)
+        return running
+
+    assert run(scenario) == 6
+
+
+def test_chats_take_turns_and_shed_their_oldest_work():
+    async def scenario(event_loop):
+        work_scheduler = WorkScheduler(
+            event_loop=event_loop,
+            concurrency=1,
+            reply_reserve=0,
+            chat_concurrency=1,
+            queue_depth=4,
+            chat_queue_depth=100,
+        )
+        blocked = event_loop.create_future()
+        started = []
+
+        def learn(name):
+            async def work():
+                started.append(name)
+                await blocked
+
+            return work
+
+        work_scheduler.submit(0, Priority.LEARNING, learn("running"))
+        for name in ("a1", "a2", "a3", "b1"):
+            work_scheduler.submit(name[0], Priority.LEARNING, learn(name))
+        # The queue is full, so the oldest queued learning gives way to the reply
+        work_scheduler.submit("c", Priority.REPLY, learn("reply"))
+        blocked.set_result(None)
+        while work_scheduler.running or work_scheduler.queued:
+            await asyncio.sleep(0.01)
+        return work_scheduler, started
+
+    work_scheduler, started = run(scenario)
+    assert work_scheduler.dropped["LEARNING"] == 1
+    assert started == ["running", "reply", "a2", "b1", "a3"]
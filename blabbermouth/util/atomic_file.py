@@ -0,0 +1,14 @@
+import contextlib
+import os
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode="w"):
+    temporary_path = "{}.tmp".format(path)
+    try:
+        with open(temporary_path, mode) as fd:
+            yield fd
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
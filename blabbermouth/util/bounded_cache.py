@@ -0,0 +1,110 @@
+import collections
+import datetime
+import time
+
+import attr
+
+from util import metrics
+from util.log import logged
+
+_ENTRIES = metrics.gauge("blabbermouth_cache_entries", "Entries held by a cache", ["cache"])
+_WEIGHT = metrics.gauge("blabbermouth_cache_weight", "Total weight of the entries of a cache", ["cache"])
+_LOOKUPS = metrics.counter(
+    "blabbermouth_cache_lookups_total", "Cache lookups by outcome", ["cache", "outcome"]
+)
+_EVICTIONS = metrics.counter("blabbermouth_cache_evictions_total", "Entries evicted from a cache", ["cache"])
+
+
+@attr.s(slots=True)
+class _Entry:
+    value = attr.ib()
+    accessed_at = attr.ib()
+    weight = attr.ib(default=0)
+
+
+@logged
+@attr.s(slots=True)
+class BoundedCache:
+    _name = attr.ib()
+    _max_size = attr.ib()
+    _idle_ttl = attr.ib(validator=attr.validators.instance_of(datetime.timedelta))
+    _max_weight = attr.ib(default=None)
+    _weigher = attr.ib(default=None)
+    _on_evict = attr.ib(default=None)
+    _entries = attr.ib(factory=collections.OrderedDict)
+    # Kept up to date on every put and eviction, so lookups never weigh the whole cache
+    _weight = attr.ib(default=0)
+
+    hits = attr.ib(default=0)
+    misses = attr.ib(default=0)
+    evictions = attr.ib(default=0)
+
+    def __attrs_post_init__(self):
+        _ENTRIES.labels(self._name).set_function(self.__len__)
+        _WEIGHT.labels(self._name).set_function(lambda: self._weight)
+        _LOOKUPS.labels(self._name, "hit").set_function(lambda: self.hits)
+        _LOOKUPS.labels(self._name, "miss").set_function(lambda: self.misses)
+        _EVICTIONS.labels(self._name).set_function(lambda: self.evictions)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        now = time.time()
+        self._evict(now)
+
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        entry.accessed_at = now
+        self._entries.move_to_end(key)
+        return entry.value
+
+    def put(self, key, value):
+        now = time.time()
+        weight = self._weigher(value) if self._weigher is not None else 0
+        replaced = self._entries.get(key)
+        if replaced is not None:
+            self._weight -= replaced.weight
+        self._entries[key] = _Entry(value=value, accessed_at=now, weight=weight)
+        self._weight += weight
+        self._entries.move_to_end(key)
+        self._evict(now)
+
+    def update_weight(self, key):
+        # Values that grow after they are put are weighed again, without counting as an access
+        entry = self._entries.get(key)
+        if entry is None or self._weigher is None:
+            return
+
+        weight = self._weigher(entry.value)
+        self._weight += weight - entry.weight
+        entry.weight = weight
+        self._evict(time.time())
+
+    def values(self):
+        return [entry.value for entry in self._entries.values()]
+
+    def _evict(self, now):
+        # Entries are kept in access order, so both idle and least recently used ones are at the front
+        idle_since = now - self._idle_ttl.total_seconds()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            is_idle = entry.accessed_at < idle_since
+            # The most recent entry is kept even if it alone outweighs the limit
+            is_over_limit = len(self._entries) > 1 and (
+                len(self._entries) > self._max_size
+                or (self._max_weight is not None and self._weight > self._max_weight)
+            )
+            if not is_idle and not is_over_limit:
+                return
+
+            del self._entries[key]
+            self._weight -= entry.weight
+            self.evictions += 1
+            self._log.info("Evicted {} from {}".format(key, self._name))
+            if self._on_evict is not None:
+                self._on_evict(key, entry.value)
@@ -0,0 +1,48 @@
+import enum
+import time
+
+import attr
+
+
+class BreakerState(enum.Enum):
+    CLOSED = enum.auto()
+    OPEN = enum.auto()
+    HALF_OPEN = enum.auto()
+
+
+@attr.s(slots=True)
+class CircuitBreaker:
+    _failure_threshold = attr.ib()
+    _reset_timeout = attr.ib()
+    _failures = attr.ib(default=0)
+    _opened_at = attr.ib(default=None)
+    _probing = attr.ib(default=False)
+
+    state = attr.ib(default=BreakerState.CLOSED)
+
+    def allow(self):
+        if self.state is BreakerState.OPEN and time.monotonic() - self._opened_at >= self._reset_timeout:
+            self.state = BreakerState.HALF_OPEN
+        if self.state is BreakerState.HALF_OPEN:
+            # A single probe at a time decides whether the breaker closes again
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+        return self.state is BreakerState.CLOSED
+
+    def record_success(self):
+        self.state = BreakerState.CLOSED
+        self._failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self._failures += 1
+        self._probing = False
+        if self.state is BreakerState.HALF_OPEN or self._failures >= self._failure_threshold:
+            self.state = BreakerState.OPEN
+            self._opened_at = time.monotonic()
+
+    def record_abandon(self):
+        # A cancelled call says nothing about the service, the next call probes again
+        self._probing = False
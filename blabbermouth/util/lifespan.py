@@ -1,4 +1,5 @@
 import datetime
+import random
 import time
 
 import attr
@@ -7,10 +8,23 @@ import attr
 @attr.s(slots=True)
 class Lifespan:
     _timeout = attr.ib(validator=attr.validators.instance_of(datetime.timedelta))
+    _jitter = attr.ib(default=0.0)
     _stamp = attr.ib(factory=time.time)
+    _span = attr.ib(default=None)
+
+    def __attrs_post_init__(self):
+        self._span = self._jittered_timeout()
 
     def __bool__(self):
-        return datetime.timedelta(seconds=(time.time() - self._stamp)) < self._timeout
+        return datetime.timedelta(seconds=(time.time() - self._stamp)) < self._span
+
+    @property
+    def stamp(self):
+        return self._stamp
+
+    def reset(self, stamp=None):
+        self._stamp = time.time() if stamp is None else stamp
+        self._span = self._jittered_timeout()
 
-    def reset(self):
-        self._stamp = time.time()
+    def _jittered_timeout(self):
+        return self._timeout * random.uniform(1 - self._jitter, 1 + self._jitter)
@@ -0,0 +1,167 @@
+import bisect
+import math
+import time
+
+import attr
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for name, value in labels
+        )
+    )
+
+
+@attr.s(slots=True)
+class _Timer:
+    _histogram = attr.ib()
+    _started_at = attr.ib(default=None)
+
+    def __enter__(self):
+        self._started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self._histogram.observe(time.perf_counter() - self._started_at)
+
+
+@attr.s(slots=True)
+class _Value:
+    _value = attr.ib(default=0.0)
+    _function = attr.ib(default=None)
+
+    def inc(self, amount=1):
+        self._value += amount
+
+    def dec(self, amount=1):
+        self._value -= amount
+
+    def set(self, value):
+        self._value = value
+
+    def set_function(self, function):
+        # Values a component already keeps are read at scrape time, at no cost on the hot path
+        self._function = function
+
+    def samples(self, name, labels):
+        yield name, labels, self._value if self._function is None else self._function()
+
+
+@attr.s(slots=True)
+class _HistogramValue:
+    _buckets = attr.ib()
+    _counts = attr.ib(default=None)
+    _sum = attr.ib(default=0.0)
+
+    def __attrs_post_init__(self):
+        self._counts = [0] * (len(self._buckets) + 1)
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._sum += value
+
+    def time(self):
+        return _Timer(histogram=self)
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self._buckets + (math.inf,), self._counts):
+            cumulative += count
+            yield "{}_bucket".format(name), labels + (("le", _format_value(bound)),), cumulative
+        yield "{}_sum".format(name), labels, self._sum
+        yield "{}_count".format(name), labels, cumulative
+
+
+@attr.s(slots=True)
+class Metric:
+    _name = attr.ib()
+    _documentation = attr.ib()
+    _kind = attr.ib()
+    _label_names = attr.ib(converter=tuple)
+    _value_factory = attr.ib()
+    _children = attr.ib(factory=dict)
+
+    def labels(self, *label_values):
+        child = self._children.get(label_values)
+        if child is None:
+            child = self._children[label_values] = self._value_factory()
+        return child
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self._name, self._documentation),
+            "# TYPE {} {}".format(self._name, self._kind),
+        ]
+        for label_values, child in list(self._children.items()):
+            for name, labels, value in child.samples(self._name, tuple(zip(self._label_names, label_values))):
+                lines.append("{}{} {}".format(name, _format_labels(labels), _format_value(value)))
+        return "\n".join(lines)
+
+
+@attr.s(slots=True)
+class MetricsRegistry:
+    _metrics = attr.ib(factory=dict)
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register(name, documentation, "counter", label_names, _Value)
+
+    def gauge(self, name, documentation, label_names=()):
+        return self._register(name, documentation, "gauge", label_names, _Value)
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._register(
+            name, documentation, "histogram", label_names, lambda: _HistogramValue(buckets=tuple(buckets))
+        )
+
+    def render(self):
+        return "".join("{}\n".format(metric.render()) for metric in list(self._metrics.values()))
+
+    def _register(self, name, documentation, kind, label_names, value_factory):
+        # Modules declare their metrics at import time, declaring one twice returns the same metric
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = Metric(
+                name=name,
+                documentation=documentation,
+                kind=kind,
+                label_names=label_names,
+                value_factory=value_factory,
+            )
+        return metric
+
+
+REGISTRY = MetricsRegistry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
@@ -0,0 +1,89 @@
+import asyncio
+import cProfile
+import os
+import time
+
+import attr
+
+from util import metrics
+from util.log import logged
+
+_LOOP_LAG_SECONDS = metrics.histogram(
+    "blabbermouth_event_loop_lag_seconds",
+    "How late the event loop wakes up a sleeping task",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
+
+
+@logged
+@attr.s(slots=True)
+class SamplingProfiler:
+    _directory = attr.ib()
+    _capture_duration = attr.ib()
+    _capture_interval = attr.ib()
+    _capturing = attr.ib(default=False)
+    _worker = attr.ib(default=None)
+
+    def start(self):
+        os.makedirs(self._directory, exist_ok=True)
+        if self._capture_interval:
+            self._worker = asyncio.ensure_future(self._capture_periodically())
+
+    def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+
+    def capture(self):
+        if self._capturing:
+            self._log.info("Profile capture is already running")
+            return
+        self._capturing = True
+        asyncio.ensure_future(self._capture())
+
+    async def _capture_periodically(self):
+        while True:
+            await asyncio.sleep(self._capture_interval)
+            if not self._capturing:
+                self._capturing = True
+                await self._capture()
+
+    async def _capture(self):
+        # Everything the event loop thread runs during the window is profiled
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                await asyncio.sleep(self._capture_duration)
+            finally:
+                profile.disable()
+            path = os.path.join(self._directory, "profile-{}.prof".format(time.strftime("%Y%m%d-%H%M%S")))
+            profile.dump_stats(path)
+            self._log.info("Dumped profile to {}".format(path))
+        finally:
+            self._capturing = False
+
+
+@logged
+@attr.s(slots=True)
+class LoopLagMonitor:
+    _event_loop = attr.ib()
+    _interval = attr.ib()
+    _threshold = attr.ib()
+    _worker = attr.ib(default=None)
+
+    def start(self):
+        self._worker = self._event_loop.create_task(self._watch())
+
+    def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+
+    async def _watch(self):
+        # A callback hogging the loop shows up as a late wake up, without the cost of asyncio debug mode
+        while True:
+            expected = self._event_loop.time() + self._interval
+            await asyncio.sleep(self._interval)
+            lag = self._event_loop.time() - expected
+            _LOOP_LAG_SECONDS.observe(lag)
+            if lag > self._threshold:
+                self._log.warning("Event loop was blocked for {:.3f}s".format(lag))
@@ -0,0 +1,122 @@
+import contextlib
+import contextvars
+import random
+import time
+
+import attr
+
+from util import metrics
+from util.log import logged
+
+_SPAN_SECONDS = metrics.histogram("blabbermouth_span_seconds", "Duration of traced spans", ["span"])
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+@attr.s(slots=True)
+class Span:
+    name = attr.ib()
+    trace = attr.ib()
+    children = attr.ib(factory=list)
+    started_at = attr.ib(factory=time.perf_counter)
+    finished_at = attr.ib(default=None)
+
+    @property
+    def duration(self):
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+    def finish(self):
+        self.finished_at = time.perf_counter()
+        _SPAN_SECONDS.labels(self.name).observe(self.duration)
+        self.trace.close_span()
+
+
+@attr.s(slots=True)
+class Trace:
+    _tracer = attr.ib()
+    root = attr.ib(default=None)
+    finished_at = attr.ib(default=None)
+    _open_spans = attr.ib(default=0)
+
+    @property
+    def duration(self):
+        return self.finished_at - self.root.started_at
+
+    def open_span(self, name, parent=None):
+        span = Span(name=name, trace=self)
+        if parent is None:
+            self.root = span
+        else:
+            parent.children.append(span)
+        self._open_spans += 1
+        return span
+
+    def close_span(self):
+        # Work handed over to other tasks keeps its spans open, the trace ends with the last of them
+        self._open_spans -= 1
+        if not self._open_spans:
+            self.finished_at = time.perf_counter()
+            self._tracer.report(self)
+
+
+@logged
+@attr.s(slots=True)
+class Tracer:
+    sample_rate = attr.ib(default=0.0)
+    slow_threshold = attr.ib(default=None)
+
+    def report(self, trace):
+        if self.slow_threshold is None or trace.duration < self.slow_threshold:
+            return
+        self._log.warning(
+            "Slow trace of {:.3f}s:\n{}".format(trace.duration, "\n".join(self._format(trace.root, depth=0)))
+        )
+
+    def _format(self, span, depth):
+        yield "{}{} {:.3f}s".format("  " * depth, span.name, span.duration)
+        for child in span.children:
+            yield from self._format(child, depth + 1)
+
+
+TRACER = Tracer()
+
+
+def start_span(name):
+    # Outside a sampled trace spans cost a context variable lookup
+    parent = _current_span.get()
+    if parent is None or parent.finished_at is not None:
+        return None
+    return parent.trace.open_span(name, parent)
+
+
+def call_in_span(span, function, *args):
+    # Tasks created by the function inherit the span, so work queued elsewhere stays in its trace
+    def call():
+        _current_span.set(span)
+        return function(*args)
+
+    return contextvars.copy_context().run(call)
+
+
+@contextlib.contextmanager
+def _activated(span):
+    if span is None:
+        yield None
+        return
+
+    token = _current_span.set(span)
+    try:
+        yield span
+    finally:
+        _current_span.reset(token)
+        span.finish()
+
+
+def trace(name):
+    if _current_span.get() is not None or random.random() >= TRACER.sample_rate:
+        return _activated(start_span(name))
+    return _activated(Trace(tracer=TRACER).open_span(name))
+
+
+def span(name):
+    return _activated(start_span(name))
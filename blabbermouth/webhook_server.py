@@ -0,0 +1,52 @@
+import asyncio
+
+import aiohttp.web
+import attr
+from telepot.aio.loop import Webhook
+
+from util.log import logged
+
+
+@logged
+@attr.s(slots=True)
+class WebhookServer:
+    _bot = attr.ib()
+    _host = attr.ib()
+    _port = attr.ib()
+    _path = attr.ib()
+    _public_url = attr.ib()
+    # Telegram keeps at most this many update requests open, handler work is bounded by the work scheduler
+    _max_connections = attr.ib()
+    _webhook = attr.ib(default=None)
+
+    def __attrs_post_init__(self):
+        self._webhook = Webhook(self._bot)
+
+    async def run_forever(self):
+        application = aiohttp.web.Application()
+        application.router.add_post(self._path, self._on_update)
+        runner = aiohttp.web.AppRunner(application)
+        await runner.setup()
+        try:
+            await aiohttp.web.TCPSite(runner, self._host, self._port).start()
+            # Without a public url updates are expected from a local harness
+            if self._public_url:
+                await self._bot.setWebhook(self._public_url, max_connections=self._max_connections)
+            await self._webhook.run_forever()
+            self._log.info("Listening for updates on {}:{}{}".format(self._host, self._port, self._path))
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    async def _on_update(self, request):
+        try:
+            update = await request.json()
+        except ValueError:
+            return aiohttp.web.Response(status=400)
+
+        # Telegram redelivers updates that were not acknowledged, so failures are only logged
+        try:
+            self._webhook.feed(update)
+        except Exception as ex:
+            self._log.error("Failed to dispatch update {}: {}".format(update.get("update_id"), ex))
+        return aiohttp.web.Response()
@@ -0,0 +1,215 @@
+import collections
+import enum
+import functools
+
+import attr
+
+from util import metrics, tracing
+from util.log import logged
+
+_QUEUED = metrics.gauge("blabbermouth_work_queued", "Handler work waiting to run", ["priority"])
+_RUNNING = metrics.gauge("blabbermouth_work_running", "Handler work running")
+_FINISHED = metrics.counter(
+    "blabbermouth_work_finished_total", "Handler work finished by outcome", ["outcome"]
+)
+_DROPPED = metrics.counter(
+    "blabbermouth_work_dropped_total", "Handler work shed under overload", ["priority"]
+)
+
+
+class Priority(enum.IntEnum):
+    REPLY = 0
+    LEARNING = 1
+    PRERENDER = 2
+
+
+def _decrement(counter, key):
+    # Counters of idle chats are removed, so they do not pile up
+    counter[key] -= 1
+    if not counter[key]:
+        del counter[key]
+
+
+@attr.s(slots=True)
+class _Work:
+    chat_id = attr.ib()
+    priority = attr.ib()
+    factory = attr.ib()
+    span = attr.ib(default=None)
+    is_queued = attr.ib(default=True)
+
+
+@attr.s(slots=True)
+class _ChatQueues:
+    # Work of a priority waits in the queue of its chat, chats that may run more work take turns
+    _by_chat = attr.ib(factory=dict)
+    _ready = attr.ib(factory=collections.OrderedDict)
+    # Arrival order is only needed for shedding, work taken out of it is skipped lazily
+    _arrivals = attr.ib(factory=collections.deque)
+    _size = attr.ib(default=0)
+
+    def __len__(self):
+        return self._size
+
+    def push(self, work, is_ready):
+        self._by_chat.setdefault(work.chat_id, collections.deque()).append(work)
+        self._arrivals.append(work)
+        self._size += 1
+        if is_ready:
+            self._ready[work.chat_id] = None
+
+    def set_ready(self, chat_id):
+        if chat_id in self._by_chat:
+            self._ready[chat_id] = None
+
+    def pop_ready(self):
+        if not self._ready:
+            return None
+        chat_id, _ = self._ready.popitem(last=False)
+        return self._take(chat_id)
+
+    def pop_oldest(self, chat_id=None):
+        if chat_id is None:
+            while self._arrivals and not self._arrivals[0].is_queued:
+                self._arrivals.popleft()
+            if not self._arrivals:
+                return None
+            chat_id = self._arrivals[0].chat_id
+        elif chat_id not in self._by_chat:
+            return None
+        return self._take(chat_id)
+
+    def _take(self, chat_id):
+        chat_queue = self._by_chat[chat_id]
+        work = chat_queue.popleft()
+        if not chat_queue:
+            del self._by_chat[chat_id]
+            self._ready.pop(chat_id, None)
+        work.is_queued = False
+        self._size -= 1
+        # Taken work is swept out in bulk, so work stuck at the front cannot hold it forever
+        if len(self._arrivals) > 2 * self._size + 16:
+            self._arrivals = collections.deque(work for work in self._arrivals if work.is_queued)
+        return work
+
+
+@logged
+@attr.s(slots=True)
+class WorkScheduler:
+    _event_loop = attr.ib()
+    _concurrency = attr.ib()
+    _reply_reserve = attr.ib()
+    _chat_concurrency = attr.ib()
+    _queue_depth = attr.ib()
+    _chat_queue_depth = attr.ib()
+    _queues = attr.ib(factory=lambda: {priority: _ChatQueues() for priority in Priority})
+    _queued_by_chat = attr.ib(factory=collections.Counter)
+    # Running work is counted per chat and priority, so slow replies do not hold learning back
+    _running_by_chat = attr.ib(factory=collections.Counter)
+    _tasks = attr.ib(factory=set)
+
+    completed = attr.ib(default=0)
+    failed = attr.ib(default=0)
+    dropped = attr.ib(factory=lambda: collections.Counter({priority.name: 0 for priority in Priority}))
+
+    def __attrs_post_init__(self):
+        for priority in Priority:
+            _QUEUED.labels(priority.name).set_function(self._queues[priority].__len__)
+            _DROPPED.labels(priority.name).set_function(functools.partial(self.dropped.get, priority.name, 0))
+        _RUNNING.set_function(lambda: self.running)
+        _FINISHED.labels("completed").set_function(lambda: self.completed)
+        _FINISHED.labels("failed").set_function(lambda: self.failed)
+
+    @property
+    def queued(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def running(self):
+        return len(self._tasks)
+
+    def submit(self, chat_id, priority, factory):
+        # Time spent in the queue is a part of the span of the work
+        work = _Work(
+            chat_id=chat_id,
+            priority=priority,
+            factory=factory,
+            span=tracing.start_span("work:{}".format(priority.name.lower())),
+        )
+        if self.queued >= self._queue_depth and not self._shed(work, chat_id=None):
+            return False
+        if self._queued_by_chat[chat_id] >= self._chat_queue_depth and not self._shed(work, chat_id=chat_id):
+            return False
+
+        self._queues[priority].push(
+            work, is_ready=self._running_by_chat[chat_id, priority] < self._chat_concurrency
+        )
+        self._queued_by_chat[chat_id] += 1
+        self._dispatch()
+        return True
+
+    def _shed(self, work, chat_id):
+        # Overload drops the oldest queued work of the lowest priority below the new one, or the new work
+        for priority in sorted(Priority, reverse=True):
+            if priority <= work.priority:
+                break
+            victim = self._queues[priority].pop_oldest(chat_id)
+            if victim is not None:
+                _decrement(self._queued_by_chat, victim.chat_id)
+                self._drop(victim)
+                return True
+        self._drop(work)
+        return False
+
+    def _drop(self, work):
+        self.dropped[work.priority.name] += 1
+        if work.span is not None:
+            work.span.finish()
+        self._log.warning("Dropped {} work for chat {}".format(work.priority.name, work.chat_id))
+
+    def _dispatch(self):
+        for priority in Priority:
+            # The last slots are left to replies, so blocked learning cannot starve them
+            limit = (
+                self._concurrency if priority == Priority.REPLY else self._concurrency - self._reply_reserve
+            )
+            queue = self._queues[priority]
+            while len(self._tasks) < limit:
+                work = queue.pop_ready()
+                if work is None:
+                    break
+                _decrement(self._queued_by_chat, work.chat_id)
+                self._start(work)
+                if self._running_by_chat[work.chat_id, priority] < self._chat_concurrency:
+                    queue.set_ready(work.chat_id)
+
+    def _start(self, work):
+        try:
+            task = tracing.call_in_span(work.span, self._event_loop.create_task, work.factory())
+        except Exception as ex:
+            # Work that cannot even be started must not hold a slot of its chat
+            self.failed += 1
+            if work.span is not None:
+                work.span.finish()
+            self._log.error("Failed to start work for chat {}: {}".format(work.chat_id, ex))
+            return
+
+        self._running_by_chat[work.chat_id, work.priority] += 1
+        self._tasks.add(task)
+        task.add_done_callback(lambda done: self._finish(work, done))
+
+    def _finish(self, work, task):
+        self._tasks.discard(task)
+        _decrement(self._running_by_chat, (work.chat_id, work.priority))
+        self._queues[work.priority].set_ready(work.chat_id)
+        if work.span is not None:
+            work.span.finish()
+
+        if task.cancelled():
+            self.failed += 1
+        elif task.exception() is not None:
+            self.failed += 1
+            self._log.error("Work for chat {} failed: {}".format(work.chat_id, task.exception()))
+        else:
+            self.completed += 1
+        self._dispatch()